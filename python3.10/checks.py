@@ -1,68 +1,138 @@
 import os
-import shutil
-import filecmp
+import time
 
 from config import Config
+from copier import DEDUPE_MODES
+from delta import DELTA_MIN_SIZE
+from file_info import FileInfo
+from index import DestinationIndex
+from metrics import metrics
+from plan import Plan
+from policy import Policy
+
+COST_METADATA, COST_INDEX, COST_CONTENT = range(3)
+CHOICES = {'y': 1, 'n': 0, 'd': 2, 'q': -1}
+POLICY_CHOICES = {'always': 1, 'never': 0, 'default': 2}
 
 
 class CheckMethod:
     """
-    Base abstract class for easier checker developement
+    Base abstract class for easier checker developement.
+    Checkers declare name of their policy in config and cost class
+    of the check, cheap ones run first:
+        COST_METADATA - uses only name, size and mode of the file
+        COST_INDEX    - looks up the destination index
+        COST_CONTENT  - may read and hash file content
     """
+    cost = COST_METADATA
+    policy = ''
+
     def __init__(self,
                  config: Config,
+                 index: DestinationIndex,
+                 plan: Plan,
                  method_name: str = '',
                  default_action_str: str = ''):
         """
-        Inits with config and method name
+        Inits with config, destination index, plan and method name
         """
         self._config = config
+        self._index = index
+        self._plan = plan
         self._method_name = method_name
         self._default_action = default_action_str
+        self._policy = config.policies.get(self.policy) or Policy('ask')
+        self._deferred: dict[str, tuple[str, FileInfo or None]] = {}
+        self.invocations = 0
+        self.hits = 0
+        self.time_spent = 0.0
+
+    @property
+    def name(self) -> str:
+        return self._method_name
 
-    def check(self, path: str) -> bool:
+    def check(self, file: FileInfo, resolve: bool = False) -> bool or None:
         """
         Main method, calls do_check virtual function and calls action
-        if required.
-        """
-        result, action_path = self._do_check(path, self._config.destination)
-        if result:
-            user_choice = self._ask_for_input(file_path=path)
-            if user_choice < 0:
-                exit(0)
-            elif user_choice == 0:
-                return False
-            elif user_choice == 1:
+        if required. Returns None if the decision is left to the user
+        and it's not yet time to <resolve> it.
+        """
+        start = time.perf_counter()
+        result, action_path = self._do_check(file, self._config.destination)
+        elapsed = time.perf_counter() - start
+        self.time_spent += elapsed
+        metrics.observe(f"check_{self.policy}", elapsed)
+        self.invocations += 1
+        if not result:
+            return True
+        self.hits += 1
+        return self._decide(file, action_path, resolve)
+
+    def resolve(self, file: FileInfo) -> bool:
+        """
+        Decides about <file> deferred by this check. Result of the check
+        is reused, unless the destination file it acted on has changed
+        since, then the file is checked again, but not counted again.
+        """
+        action_path, acted_on = self._deferred.pop(file.path)
+        if self._index.lookup(action_path) is not acted_on:
+            result, action_path = self._do_check(file,
+                                                 self._config.destination)
+            if not result:
                 return True
-            else:
-                return self._action(path, action_path)
-        return True
-
-    def _do_check(self, path: str, destination_path: str) -> tuple[bool, str]:
+        return self._decide(file, action_path, True)
+
+    def _decide(self, file: FileInfo, action_path: str,
+                resolve: bool) -> bool or None:
+        """
+        Applies policy, decision or user choice to <file> that requires
+        action, deferring it if it's not yet time to <resolve> it
+        """
+        action = self._policy.decide(file)
+        if action != 'ask':
+            user_choice = POLICY_CHOICES[action]
+        elif not resolve:
+            self._deferred[file.path] = (action_path,
+                                         self._index.lookup(action_path))
+            return None
+        else:
+            user_choice = self._resolve(file)
+        if user_choice < 0:
+            exit(0)
+        elif user_choice == 0:
+            return False
+        elif user_choice == 1:
+            return True
+        else:
+            return self._action(file, action_path)
+
+    def _do_check(self, file: FileInfo,
+                  destination_path: str) -> tuple[bool, str]:
         """
         Performs check and returns True if action is required and provides
         action path as second tuple element
         """
         raise NotImplementedError()
 
-    def _action(self, path: str, action_path: str) -> bool:
+    def _action(self, file: FileInfo, action_path: str) -> bool:
         """
-        Performs action and returns true if <path> file can be
+        Performs action and returns true if <file> can be
         safely copied to destination folder
         """
         raise NotImplementedError()
 
-    def _copy_file(self, path: str):
+    def _copy_file(self, file: FileInfo, name: str = ''):
         """
-        Copies file from source to path relative to destination folder
+        Plans copy of file from source to path relative to destination
+        folder, optionally under a different name
         """
-        destination_path = self._config.destination
-        for level in path.split(os.sep)[:-1]:
-            destination_path = os.path.join(destination_path, level)
-            if not os.path.exists(destination_path):
-                os.mkdir(destination_path)
+        self._plan.copy(file, name)
 
-        shutil.copy(src=path, dst=destination_path)
+    def _remove_file(self, path: str):
+        """
+        Plans removal of file from destination folder
+        """
+        self._plan.delete(path)
 
     def _log_action(self, path: str):
         """
@@ -71,17 +141,31 @@ class CheckMethod:
         print(f"> {self._method_name:<20}: {path:<35}"
               + f" | DEFAULT: {self._default_action:<30}")
 
-    def _ask_for_input(self, file_path: str) -> str:
+    def _resolve(self, file: FileInfo) -> int:
+        """
+        Takes decision about <file> from decisions file,
+        applies default in batchmode, asks user otherwise
+        """
+        decision = self._config.decisions.get(file.path, '')
+        if isinstance(decision, dict):
+            decision = decision.get(self.policy, '')
+        if decision:
+            return CHOICES[decision]
+        if self._config.batchmode:
+            return CHOICES['d']
+        return self._ask_for_input(file_path=file.path)
+
+    def _ask_for_input(self, file_path: str) -> int:
         """
         Ask user for input for provided action
         [no - N, yes - Y, default - D, quit - Q].
         """
-        CHOICES = {'y': 1, 'n': 0, 'd': 2, 'q': -1}
         self._log_action(file_path)
-        choice = input('Copy? >(N)o (Y)es (D)efault behaviour (Q)uit $')\
-            .lower()
-        while choice not in CHOICES.keys():
-            choice = input('Copy? >(N)o (Y)es (D)efault behaviour: ')
+        with metrics.timer('input_wait'):
+            choice = input('Copy? >(N)o (Y)es (D)efault behaviour (Q)uit $')\
+                .lower()
+            while choice not in CHOICES.keys():
+                choice = input('Copy? >(N)o (Y)es (D)efault behaviour: ')
         return CHOICES[choice]
 
 
@@ -89,33 +173,105 @@ class CheckDuplicateContent(CheckMethod):
     """
     Check if file has it's duplicate in the destination folder.
     """
-    def __init__(self, config: Config):
-        super().__init__(config, 'Duplicate content', 'Keeping the oldest.')
+    cost = COST_CONTENT
+    policy = 'duplicate_content'
+
+    def __init__(self, config: Config, index: DestinationIndex,
+                 plan: Plan):
+        if config.dedupe and config.dedupe not in DEDUPE_MODES:
+            raise ValueError(f"{config.dedupe} is not one of"
+                             + f" {', '.join(DEDUPE_MODES)}.")
+        super().__init__(config, index, plan, 'Duplicate content',
+                         f"Make a {config.dedupe}." if config.dedupe
+                         else 'Keeping the oldest.')
 
-    def _do_check(self, path: str, destination_path: str) -> tuple[bool, str]:
+    def _do_check(self, file: FileInfo,
+                  destination_path: str) -> tuple[bool, str]:
         """
         Requires action if
         the file already exists in destination dir.
         """
-        for filename in os.listdir(destination_path):
-            new_path = os.path.join(destination_path, filename)
-            if os.path.isfile(new_path):
-                if filecmp.cmp(new_path, path):
-                    return True, new_path
-            else:
-                is_duplicate, new_path = self._do_check(path, new_path)
-                if is_duplicate:
-                    return is_duplicate, new_path
-        return False, ''
+        duplicate_path = self._index.find_duplicate(file)
+        return bool(duplicate_path), duplicate_path
 
-    def _action(self, path: str, action_path: str):
+    def _action(self, file: FileInfo, action_path: str):
         """
-        DEFAULT: Keeps the oldest of the two files.
+        DEFAULT: Keeps the oldest of the two files. In dedupe mode
+        the file is linked to the existing one instead.
         """
-        is_older = os.path.getctime(path) > \
-            os.path.getctime(action_path)
+        if self._config.dedupe:
+            self._plan.link(file, action_path, self._config.dedupe)
+            return True
+        is_older = file.ctime > self._index.get(action_path).ctime
         if is_older:
-            os.remove(action_path)
+            self._remove_file(action_path)
+        return is_older
+
+
+class CheckNearDuplicate(CheckMethod):
+    """
+    Check if destination folder contains files with almost the same
+    content, like re-saved documents or logs differing in headers.
+    Similarity is estimated from signatures of their lines.
+    """
+    cost = COST_CONTENT
+    policy = 'near_duplicate'
+
+    def __init__(self, config: Config, index: DestinationIndex,
+                 plan: Plan):
+        if not 0 < config.near_duplicates <= 1:
+            raise ValueError(f"{config.near_duplicates} is not"
+                             + " between 0 and 1.")
+        super().__init__(config, index, plan, 'Near duplicate',
+                         'Keeping the oldest.')
+        self._clusters: dict[str, list[tuple[str, float]]] = {}
+
+    def _do_check(self, file: FileInfo,
+                  destination_path: str) -> tuple[bool, str]:
+        """
+        Requires action if files at least near_duplicates similar
+        exist in destination, the most similar one is acted on.
+        Files with an exact duplicate are left to CheckDuplicateContent.
+        """
+        cluster = self._index.find_similar(
+            file, self._config.near_duplicates) \
+            if file.size and not self._index.find_duplicate(file) else []
+        if not cluster:
+            self._clusters.pop(file.path, None)
+            return False, ''
+        # Kept until the file is decided about, it may be deferred
+        self._clusters[file.path] = cluster
+        return True, cluster[0][0]
+
+    def _decide(self, file: FileInfo, action_path: str,
+                resolve: bool) -> bool or None:
+        """
+        Forgets cluster of <file> once it is decided about
+        """
+        result = super()._decide(file, action_path, resolve)
+        if result is not None:
+            del self._clusters[file.path]
+        return result
+
+    def _log_action(self, path: str):
+        """
+        Logs file that didn't pass check with its cluster of similar files
+        """
+        super()._log_action(path)
+        print(f"> {'':<20}  SIMILAR: " + ', '.join(
+            f"{similar} ({value:.0%})"
+            for similar, value in self._clusters.get(path, ())))
+
+    def _action(self, file: FileInfo, action_path: str):
+        """
+        DEFAULT: Keeps the oldest of the two files, like
+        CheckDuplicateContent. Files copied or linked to
+        in this run are always kept.
+        """
+        is_older = file.ctime > self._index.get(action_path).ctime \
+            and not self._plan.is_planned(action_path)
+        if is_older:
+            self._remove_file(action_path)
         return is_older
 
 
@@ -123,16 +279,21 @@ class CheckEmpty(CheckMethod):
     """
     Check if file is empty
     """
-    def __init__(self, config: Config):
-        super().__init__(config, "Empty file", 'Don\'t copy.')
+    policy = 'empty'
+
+    def __init__(self, config: Config, index: DestinationIndex,
+                 plan: Plan):
+        super().__init__(config, index, plan,
+                         "Empty file", 'Don\'t copy.')
 
-    def _do_check(self, path: str, destination_path: str) -> tuple[bool, str]:
+    def _do_check(self, file: FileInfo,
+                  destination_path: str) -> tuple[bool, str]:
         """
         Requires action if the file is empty
         """
-        return os.stat(path).st_size == 0, ''
+        return file.size == 0, ''
 
-    def _action(self, path: str, action_path: str):
+    def _action(self, file: FileInfo, action_path: str):
         """
         DEFAULT: Don't copy empty files
         """
@@ -143,17 +304,21 @@ class CheckTemporary(CheckMethod):
     """
     Check if file is a temporary file
     """
-    def __init__(self, config: Config):
-        super().__init__(config, "TMP file", "Don\'t copy.")
+    policy = 'temporary'
+
+    def __init__(self, config: Config, index: DestinationIndex,
+                 plan: Plan):
+        super().__init__(config, index, plan,
+                         "TMP file", "Don\'t copy.")
 
-    def _do_check(self, path: str, destination_path: str) -> tuple[bool, str]:
+    def _do_check(self, file: FileInfo,
+                  destination_path: str) -> tuple[bool, str]:
         """
         Requires action if the file is temporary
         """
-        return any([path.endswith(ext)
-                    for ext in self._config.temporary_extensions]), ''
+        return file.name.endswith(self._config.temporary_suffixes), ''
 
-    def _action(self, path: str, action_path: str):
+    def _action(self, file: FileInfo, action_path: str):
         """
         DEFAULT: Don't copy tmp files
         """
@@ -164,34 +329,35 @@ class CheckDuplicateName(CheckMethod):
     """
     Check if destination folder already contains file with the same name
     """
-    def __init__(self, config: Config):
-        super().__init__(config, "Duplicate name", 'Keeping the newest.')
+    cost = COST_INDEX
+    policy = 'duplicate_name'
 
-    def _do_check(self, path: str, destination_path: str) -> tuple[bool, str]:
+    def __init__(self, config: Config, index: DestinationIndex,
+                 plan: Plan):
+        super().__init__(config, index, plan,
+                         "Duplicate name", 'Keeping the newest.')
+
+    def _do_check(self, file: FileInfo,
+                  destination_path: str) -> tuple[bool, str]:
         """
         Requires action if the file with the same name
         already exists in destination.
         """
-        file_name = path.split(os.sep)[-1]
-        for filename in os.listdir(destination_path):
-            new_path = os.path.join(destination_path, filename)
-            if os.path.isfile(new_path):
-                if file_name == filename:
-                    return True, new_path
-            else:
-                is_duplicate, new_path = self._do_check(path, new_path)
-                if is_duplicate:
-                    return is_duplicate, new_path
-        return False, ''
+        duplicate_path = self._index.find_name(file.name)
+        return bool(duplicate_path), duplicate_path
 
-    def _action(self, path: str, action_path: str):
+    def _action(self, file: FileInfo, action_path: str):
         """
         DEFAULT: Keeps the newest of the two files.
+        Large files replace the older one by a delta copy.
         """
-        is_newer = os.path.getctime(path) > \
-            os.path.getctime(action_path)
+        existing = self._index.get(action_path)
+        is_newer = file.ctime > existing.ctime
         if is_newer:
-            os.remove(action_path)
+            if min(file.size, existing.size) >= DELTA_MIN_SIZE:
+                self._plan.delta(file, action_path)
+            else:
+                self._remove_file(action_path)
         return is_newer
 
 
@@ -199,26 +365,25 @@ class CheckPermissions(CheckMethod):
     """
     Check if file has unusual permissions
     """
-    def __init__(self, config: Config):
-        super().__init__(config, "Bad Permissions", 'Change to default.')
+    policy = 'permissions'
+
+    def __init__(self, config: Config, index: DestinationIndex,
+                 plan: Plan):
+        super().__init__(config, index, plan,
+                         "Bad Permissions", 'Change to default.')
 
-    def _do_check(self, path: str, destination_path: str) -> tuple[bool, str]:
+    def _do_check(self, file: FileInfo,
+                  destination_path: str) -> tuple[bool, str]:
         """
         Requires action if the file has unusual permissions defined in config
         """
-        st = os.stat(path)
-        file_perms = f"{oct(st.st_mode)[-3:]}"
-        if file_perms in [str(self._config.get_oct_permissions(perm))
-                          for perm in self._config.unusual_permissions]:
-            return True, ''
-        return False, ''
+        return file.mode & 0o777 in self._config.unusual_modes, ''
 
-    def _action(self, path: str, action_path: str):
+    def _action(self, file: FileInfo, action_path: str):
         """
         DEFAULT: Change to default
         """
-        os.chmod(path, self._config.get_oct_permissions(
-                 self._config.default_permission))
+        self._plan.chmod(file, self._config.default_mode)
         return True
 
 
@@ -226,34 +391,26 @@ class CheckName(CheckMethod):
     """
     Check if file has dangerous characters in name
     """
-    def __init__(self, config: Config):
-        super().__init__(config, "Bad name", 'Replace bad chars.')
+    policy = 'name'
+
+    def __init__(self, config: Config, index: DestinationIndex,
+                 plan: Plan):
+        super().__init__(config, index, plan,
+                         "Bad name", 'Replace bad chars.')
 
-    def _do_check(self, path: str, destination_path: str) -> tuple[bool, str]:
+    def _do_check(self, file: FileInfo,
+                  destination_path: str) -> tuple[bool, str]:
         """
         Requires action if the file has unusual permissions defined in config
         """
-        file_name = path.split(os.sep)[-1]
-        if any([bad_char in file_name for
-                bad_char in self._config.dangerous_characters]):
-
-            new_file_name = file_name
-            for bad_char in self._config.dangerous_characters:
-                new_file_name = new_file_name.replace(
-                    bad_char,
-                    self._config.default_character)
-
-            new_file_path = path.replace(file_name, new_file_name)
+        if self._config.dangerous_pattern.search(file.name) is None:
+            return False, ''
+        new_file_name = file.name.translate(self._config.name_translation)
+        return True, os.path.join(os.path.dirname(file.path), new_file_name)
 
-            return True, new_file_path
-
-        return False, ''
-
-    def _action(self, path: str, action_path: str):
+    def _action(self, file: FileInfo, action_path: str):
         """
         DEFAULT: Change to default name
         """
-        os.rename(path, action_path)
-        super()._copy_file(action_path)
-        os.rename(action_path, path)
-        return False
+        self._plan.rename(file, os.path.basename(action_path))
+        return True
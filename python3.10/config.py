@@ -1,31 +1,190 @@
 import os
+import re
 import json
 
+from duplicates import SURVIVORS
+from hasher import ALGORITHMS
+from plan import Plan
+from policy import Policy
+from walker import ORDERS, SPECIAL_FILE_POLICIES, SYMLINK_POLICIES
+
 CONFIG_FILE = 'config.json'
 RWX_TO_NUMBER = {'r': 4, 'w': 2, 'x': 1, '-': 0}
+CONFIG_SCHEMA = {
+    'default_character': str,
+    'default_permission': str,
+    'dangerous_characters': list,
+    'unusual_permissions': list,
+    'temporary_extensions': list,
+    'catalog_name': str,
+    'walk_order': str,
+    'symlinks': str,
+    'special_files': str,
+    'hash_algorithm': str,
+    'policies': dict,
+    'duplicate_survivor': str,
+    'journal_name': str,
+    'queue_size': int,
+    'digest_cache_size': int,
+}
+# Keys added after the first version of the config file are optional
+CONFIG_DEFAULTS = {
+    'catalog_name': '.file_manager_catalog.sqlite',
+    'walk_order': 'dfs',
+    'symlinks': 'files',
+    'special_files': 'warn',
+    'hash_algorithm': 'blake2b',
+    'policies': {},
+    'duplicate_survivor': 'oldest',
+    'journal_name': '.file_manager_journal',
+    'queue_size': 256,
+    'digest_cache_size': 65536,
+}
+DECISIONS = ('y', 'n', 'd')
 dirname = os.path.dirname(__file__)
 config_path = os.path.join(dirname, CONFIG_FILE)
 
 
 class Config:
     """
-    Class responsible for config management
+    Class responsible for config management.
+    Rules from the config file are validated and compiled once on load:
+    unusual_modes        - frozenset of integer permission modes
+    default_mode         - integer permission mode
+    dangerous_pattern    - compiled character class of dangerous characters
+    name_translation     - str.translate table replacing dangerous characters
+    temporary_suffixes   - tuple of suffixes for str.endswith
+    policies             - Policy of every check by its name
     """
     def __init__(self,
                  destination: str,
                  source: list[str],
+                 jobs: int = 1,
+                 hash_jobs: int = 1,
+                 scan_jobs: int = 1,
+                 shards: int = 1,
+                 copy_mode: str = 'auto',
+                 dedupe: str = '',
+                 checksum: bool = False,
+                 near_duplicates: float = 0,
+                 dry_run: bool = False,
+                 plan_file: str = '',
+                 execute_file: str = '',
+                 batchmode: bool = False,
+                 decisions_file: str = '',
+                 resume: bool = False,
+                 watch: bool = False,
                  filename: str = config_path):
         self.destination = destination
         self.source = source
+        self.jobs = jobs
+        self.hash_jobs = hash_jobs
+        self.scan_jobs = scan_jobs
+        self.shards = shards
+        self.copy_mode = copy_mode
+        self.dedupe = dedupe
+        self.checksum = checksum
+        self.near_duplicates = near_duplicates
+        self.dry_run = dry_run
+        self.plan_file = plan_file
+        self.execute_file = execute_file
+        self.batchmode = batchmode
+        self.resume = resume
+        self.watch = watch
         self._filename = filename
         self._json = self.get_json_content()
+        self._compile()
+        self.decisions = self.get_decisions(decisions_file) \
+            if decisions_file else {}
+        self.saved_operations = Plan.load_operations(
+            execute_file, destination) if execute_file else []
 
     def get_json_content(self) -> dict:
         with open(self._filename) as file:
             return json.load(file)
 
+    def _validate(self):
+        """
+        Checks that config file has all keys of expected types,
+        missing optional keys are given their defaults
+        """
+        for key, value in CONFIG_DEFAULTS.items():
+            self._json.setdefault(key, value)
+        for key, expected in CONFIG_SCHEMA.items():
+            if key not in self._json:
+                raise ValueError(f"{self._filename}: missing key {key}.")
+            if not isinstance(self._json[key], expected):
+                raise ValueError(f"{self._filename}: {key} should be"
+                                 + f" of type {expected.__name__}.")
+        for key in self._json.keys() - CONFIG_SCHEMA.keys():
+            raise ValueError(f"{self._filename}: unknown key {key}.")
+        if not all(isinstance(char, str) and len(char) == 1
+                   for char in self._json['dangerous_characters']):
+            raise ValueError(f"{self._filename}: dangerous_characters"
+                             + " should be a list of single characters.")
+        if not all(isinstance(ext, str) and ext
+                   for ext in self._json['temporary_extensions']):
+            raise ValueError(f"{self._filename}: temporary_extensions"
+                             + " should be a list of non-empty strings.")
+        for key, allowed in (('walk_order', ORDERS),
+                             ('symlinks', SYMLINK_POLICIES),
+                             ('special_files', SPECIAL_FILE_POLICIES),
+                             ('hash_algorithm', ALGORITHMS),
+                             ('duplicate_survivor', SURVIVORS)):
+            if self._json[key] not in allowed:
+                raise ValueError(f"{self._filename}: {key} should"
+                                 + f" be one of {', '.join(allowed)}.")
+        for key in ('queue_size', 'digest_cache_size'):
+            if self._json[key] < 1:
+                raise ValueError(f"{self._filename}: {key}"
+                                 + " should be positive.")
+        if any(char in self._json['default_character']
+               for char in self._json['dangerous_characters']):
+            raise ValueError(f"{self._filename}: default_character"
+                             + " can't be dangerous.")
+
+    def _compile(self):
+        """
+        Validates config and compiles rules into fast immutable structures
+        """
+        self._validate()
+        for key in CONFIG_SCHEMA:
+            value = self._json[key]
+            setattr(self, key, tuple(value) if isinstance(value, list)
+                    else value)
+
+        self.unusual_modes = frozenset(
+            self.get_oct_permissions(perm)
+            for perm in self.unusual_permissions)
+        self.default_mode = self.get_oct_permissions(self.default_permission)
+        self.dangerous_pattern = re.compile(
+            '[' + ''.join(map(re.escape, self.dangerous_characters)) + ']')
+        self.name_translation = str.maketrans(
+            dict.fromkeys(self.dangerous_characters, self.default_character))
+        self.temporary_suffixes = self.temporary_extensions
+        self.policies = {name: Policy(rules)
+                         for name, rules in self._json['policies'].items()}
+
+    def get_decisions(self, filename: str) -> dict[str, str or dict]:
+        """
+        Reads decisions about deferred conflicts: source path mapped to
+        y/n/d, or to a dict of y/n/d by check policy name
+        """
+        with open(filename) as file:
+            decisions = json.load(file)
+        if not isinstance(decisions, dict):
+            raise ValueError(f"{filename}: should map paths to decisions.")
+        for path, decision in decisions.items():
+            for value in decision.values() if isinstance(decision, dict) \
+                    else (decision,):
+                if value not in DECISIONS:
+                    raise ValueError(f"{filename}: {path}: {value} is not"
+                                     + f" one of {', '.join(DECISIONS)}.")
+        return decisions
+
     def get_oct_permissions(self, permissions: str) -> int:
-        if len(permissions) != 9:
+        if len(permissions) != 9 or \
+                any(perm_bit not in RWX_TO_NUMBER for perm_bit in permissions):
             raise ValueError(
                 f"{permissions} is not a valid permission string.")
         result = ""
@@ -34,11 +193,9 @@ class Config:
             for perm_bit in permissions[i:i+3]:
                 partition += RWX_TO_NUMBER[perm_bit]
             result += str(partition)
-        return int(result)
+        return int(result, 8)
 
-    def __getattr__(self, __name: str) -> str or list[str]:
-        if __name in self._json.keys():
-            return self._json[__name]
+    def __getattr__(self, __name: str):
         raise AttributeError(
             f"{self.__class__.__name__} nie ma atrybutu {__name}."
         )
@@ -0,0 +1,514 @@
+import os
+import mmap
+import errno
+import shutil
+import threading
+from collections import Counter
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO
+
+from archive import extract, member_of
+from delta import DELTA_MAX_LITERAL, LITERAL, block_size, match, signature
+from index import DestinationIndex
+from metrics import metrics
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FICLONE = 0x40049409
+BUFFER_SIZE = 1024 * 1024
+UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTTY,
+                      errno.EOPNOTSUPP, errno.EBADF)
+COPY_MODES = {
+    'auto': ('reflink', 'copy_file_range', 'sendfile', 'buffered'),
+    'reflink': ('reflink',),
+    'kernel': ('copy_file_range', 'sendfile'),
+    'buffered': ('buffered',),
+}
+
+
+def _reflink(source: BinaryIO, target: BinaryIO, size: int) -> bool:
+    """
+    Clones the file extents (btrfs, XFS), no data is written
+    """
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+    except OSError as error:
+        if error.errno in UNSUPPORTED_ERRNOS:
+            return False
+        raise
+    return True
+
+
+def _kernel_copy(function, source: BinaryIO, target: BinaryIO,
+                 size: int) -> bool:
+    """
+    Copies data inside the kernel with copy_file_range or sendfile
+    """
+    offset = 0
+    while offset < size:
+        try:
+            copied = function(source.fileno(), target.fileno(), offset,
+                              size - offset)
+        except OSError as error:
+            if offset == 0 and error.errno in UNSUPPORTED_ERRNOS:
+                return False
+            raise
+        if copied == 0:
+            break
+        offset += copied
+    return True
+
+
+def _copy_file_range(source: BinaryIO, target: BinaryIO, size: int) -> bool:
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    return _kernel_copy(
+        lambda src, dst, offset, count: os.copy_file_range(
+            src, dst, count, offset_src=offset, offset_dst=offset),
+        source, target, size)
+
+
+def _sendfile(source: BinaryIO, target: BinaryIO, size: int) -> bool:
+    if not hasattr(os, 'sendfile'):
+        return False
+    return _kernel_copy(
+        lambda src, dst, offset, count: os.sendfile(dst, src, offset, count),
+        source, target, size)
+
+
+def _buffered(source: BinaryIO, target: BinaryIO, size: int) -> bool:
+    shutil.copyfileobj(source, target, BUFFER_SIZE)
+    return True
+
+
+STRATEGIES = {
+    'reflink': _reflink,
+    'copy_file_range': _copy_file_range,
+    'sendfile': _sendfile,
+    'buffered': _buffered,
+}
+
+
+def hardlink_file(origin: str, path: str, target: str):
+    """
+    Links <target> to the inode of <origin>, sharing its mode
+    """
+    try:
+        os.remove(target)
+    except FileNotFoundError:
+        pass
+    os.link(origin, target)
+
+
+def reflink_file(origin: str, path: str, target: str):
+    """
+    Clones extents of <origin> into <target>, mode and times are copied
+    from <path>
+    """
+    with open(origin, 'rb') as source, open(target, 'wb') as clone:
+        if not _reflink(source, clone, 0):
+            raise OSError(errno.EOPNOTSUPP, "reflink is not supported",
+                          target)
+    shutil.copystat(path, target)
+
+
+DEDUPE_MODES = {
+    'hardlink': hardlink_file,
+    'reflink': reflink_file,
+}
+
+
+def copy_file(src: str, dst: str, mode: str = 'auto') -> str:
+    """
+    Copies content, permission bits and times of <src> to <dst> trying
+    strategies allowed by copy <mode> in order. Times are kept so unchanged
+    files can be recognized by size and mtime on the next run.
+    Returns name of the strategy used.
+    """
+    with open(src, 'rb') as source, open(dst, 'wb') as target:
+        size = os.fstat(source.fileno()).st_size
+        for strategy in COPY_MODES[mode]:
+            if STRATEGIES[strategy](source, target, size):
+                break
+            source.seek(0)
+            target.seek(0)
+            target.truncate()
+        else:
+            strategy = ''
+    if not strategy:
+        os.remove(dst)
+        raise OSError(errno.EOPNOTSUPP, f"{mode} copy is not supported", src)
+    shutil.copystat(src, dst)
+    return strategy
+
+
+def _copy_range(source: BinaryIO, target: BinaryIO, offset: int,
+                target_offset: int, length: int):
+    """
+    Copies <length> bytes between offsets of open files,
+    inside the kernel if possible
+    """
+    if hasattr(os, 'copy_file_range'):
+        while length > 0:
+            copied = os.copy_file_range(
+                source.fileno(), target.fileno(), length,
+                offset_src=offset, offset_dst=target_offset)
+            if copied == 0:
+                break
+            offset += copied
+            target_offset += copied
+            length -= copied
+        return
+    source.seek(offset)
+    target.seek(target_offset)
+    target.write(source.read(length))
+
+
+def delta_file(basis: str, src: str, dst: str, mode: str = 'auto') -> str:
+    """
+    Writes content of <src> to <dst> reusing blocks of destination file
+    <basis> it replaces, found with rolling checksums like rsync does.
+    The new file is assembled in a reflink clone of <basis>, so only
+    changed regions are written, and renamed to <dst>. Falls back
+    to a full copy without <basis>, if <basis> can't be cloned
+    or too much of <src> isn't found in it.
+    Returns name of the strategy used.
+    """
+    temporary = os.path.join(os.path.dirname(dst),
+                             f".{os.path.basename(dst)}.{os.getpid()}.delta")
+    try:
+        basis_file = open(basis, 'rb')
+    except FileNotFoundError:
+        return copy_file(src, dst, mode)
+    try:
+        with basis_file, open(src, 'rb') as source, \
+                open(temporary, 'wb', buffering=0) as target:
+            size = os.fstat(source.fileno()).st_size
+            max_literal = int(size * DELTA_MAX_LITERAL)
+            written = literal = 0
+            # Without a clone every block would be written anyway
+            delta = size and _reflink(basis_file, target, 0)
+            if delta:
+                block = block_size(size)
+                blocks = signature(basis_file, block)
+                with mmap.mmap(source.fileno(), 0,
+                               access=mmap.ACCESS_READ) as data:
+                    for offset, length, origin in match(
+                            data, size, block, blocks,
+                            os.fstat(basis_file.fileno()).st_size,
+                            max_literal):
+                        if origin == offset:
+                            continue
+                        if origin == LITERAL:
+                            literal += length
+                            if literal > max_literal:
+                                delta = False
+                                break
+                            target.seek(offset)
+                            target.write(data[offset:offset + length])
+                        else:
+                            _copy_range(basis_file, target, origin, offset,
+                                        length)
+                        written += length
+                target.truncate(size)
+        if delta:
+            shutil.copystat(src, temporary)
+            os.replace(temporary, dst)
+        else:
+            os.remove(temporary)
+            strategy = copy_file(src, dst, mode)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    if basis != dst:
+        try:
+            os.remove(basis)
+        except FileNotFoundError:
+            # Already removed by another shard
+            pass
+    if not delta:
+        return strategy
+    metrics.count('delta_bytes_written', written)
+    return 'delta'
+
+
+class Extraction:
+    """
+    Member <path> of an archive queued to be written to <target>,
+    replacing <basis> and getting <mode>, if given
+    """
+    __slots__ = ('path', 'target', 'basis', 'mode', 'done')
+
+    def __init__(self, path: str, target: str, basis: str = ''):
+        self.path = path
+        self.target = target
+        self.basis = basis
+        self.mode: int or None = None
+        self.done: list[Callable[[], None]] = []
+
+    def complete(self):
+        """
+        Calls callbacks of operations done by writing the member
+        """
+        for done in self.done:
+            done()
+
+
+def _remove_basis(extraction: Extraction):
+    """
+    Removes destination file replaced by the member
+    """
+    if extraction.basis not in ('', extraction.target):
+        try:
+            os.remove(extraction.basis)
+        except FileNotFoundError:
+            pass
+
+
+def _finish_extraction(extraction: Extraction):
+    """
+    Applies mode planned for written member and removes file it replaces
+    """
+    if extraction.mode is not None:
+        os.chmod(extraction.target, extraction.mode)
+    _remove_basis(extraction)
+
+
+def extract_members(archive: str,
+                    extractions: dict[str, tuple[Extraction, Future]]):
+    """
+    Writes queued members of <archive> in a single read of it,
+    resolving future of each (member path: extraction, future)
+    of <extractions> once the member is written
+    """
+    try:
+        for path, error in extract(archive, {
+                path: extraction.target
+                for path, (extraction, _) in extractions.items()}):
+            extraction, future = extractions.pop(path)
+            try:
+                if error is not None:
+                    raise error
+                _finish_extraction(extraction)
+            except OSError as failure:
+                future.set_exception(failure)
+            else:
+                future.set_result('archive')
+    except Exception as error:
+        for _, future in extractions.values():
+            future.set_exception(error)
+        return
+    for path, (_, future) in extractions.items():
+        future.set_exception(OSError(errno.ENOENT, "not found in archive",
+                                     path))
+
+
+class CopyExecutor:
+    """
+    Copies files to destination folder on a bounded pool of worker threads.
+    Copies are scheduled in plan order, only the bytes transfer overlaps.
+    Members of <archives> are queued instead and written all at once,
+    in a single read of their archive, when the copies are closed
+    or when a later operation needs one of them.
+    """
+    def __init__(self, index: DestinationIndex,
+                 jobs: int = 1, mode: str = 'auto',
+                 archives: tuple[str, ...] = ()):
+        if mode not in COPY_MODES:
+            raise ValueError(
+                f"{mode} is not one of {', '.join(COPY_MODES)}.")
+        self._index = index
+        self._mode = mode
+        self._pool = ThreadPoolExecutor(max_workers=jobs)
+        self._capacity = 2 * jobs
+        self._slots = threading.BoundedSemaphore(self._capacity)
+        self._pending: dict[str, Future] = {}
+        self._callbacks: dict[str, Callable[[], None]] = {}
+        self._archives = archives
+        self._extractions: dict[str, dict[str, Extraction]] = {}
+        self.errors: list[tuple[str, Exception]] = []
+        self.strategies: Counter[str] = Counter()
+
+    def copy(self, path: str, target: str,
+             done: Callable[[], None] or None = None, basis: str = ''):
+        """
+        Schedules copy of <path> to <target> in destination folder,
+        as a delta against <basis> if given. Archive members are queued
+        and replace <basis> once written.
+        <done> is called once the copy succeeds
+        """
+        self.wait(target)
+        if basis:
+            self.wait(basis)
+        archive = member_of(path, self._archives)
+        if archive:
+            extraction = Extraction(path, target, basis)
+            if done is not None:
+                extraction.done.append(done)
+            self._extractions.setdefault(archive, {})[target] = extraction
+            return
+        self._slots.acquire()
+        self._settle_done()
+        if basis:
+            future = self._pool.submit(delta_file, basis, path, target,
+                                       self._mode)
+        else:
+            future = self._pool.submit(copy_file, path, target, self._mode)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._pending[target] = future
+        if done is not None:
+            self._callbacks[target] = done
+
+    def link(self, origin: str, path: str, target: str, kind: str,
+             done: Callable[[], None] or None = None):
+        """
+        Makes <target> a hardlink or reflink (<kind>) of destination file
+        <origin> with the same content as <path>. Falls back to copying
+        <path> if <origin> can't be linked, e.g. across filesystems.
+        """
+        self.wait(origin)
+        self.wait(target)
+        try:
+            DEDUPE_MODES[kind](origin, path, target)
+        except OSError:
+            self.copy(path, target, done)
+            return
+        self.strategies[kind] += 1
+        metrics.count(f"copies_{kind}")
+        self._index.settle(target)
+        metrics.count('files_linked')
+        if done is not None:
+            done()
+
+    def chmod(self, path: str, mode: int,
+              done: Callable[[], None] or None = None):
+        """
+        Changes mode of <path> once the copy to it is finished,
+        archive member queued for <path> gets it when it's written
+        """
+        extraction = self._queued(path)
+        if extraction is not None:
+            extraction.mode = mode
+            if done is not None:
+                extraction.done.append(done)
+            return
+        self.wait(path)
+        os.chmod(path, mode)
+        if done is not None:
+            done()
+
+    def discard(self, path: str):
+        """
+        Drops archive member queued for <path> planned to be deleted,
+        its operations are done without writing it
+        """
+        for queued in self._extractions.values():
+            extraction = queued.pop(path, None)
+            if extraction is not None:
+                _remove_basis(extraction)
+                extraction.complete()
+                return
+
+    def _queued(self, path: str) -> Extraction or None:
+        for queued in self._extractions.values():
+            if path in queued:
+                return queued[path]
+        return None
+
+    def _extract(self, archive: str):
+        """
+        Schedules writing of members queued from <archive>
+        """
+        queued = self._extractions.pop(archive)
+        if not queued:
+            return
+        extractions: dict[str, tuple[Extraction, Future]] = {}
+        for target, extraction in queued.items():
+            future = Future()
+            # Resolved by extract_members, it can't be cancelled
+            future.set_running_or_notify_cancel()
+            extractions[extraction.path] = (extraction, future)
+            self._pending[target] = future
+            self._callbacks[target] = extraction.complete
+        self._slots.acquire()
+        self._pool.submit(extract_members, archive, extractions) \
+            .add_done_callback(lambda _: self._slots.release())
+
+    def flush(self):
+        """
+        Schedules writing of all queued archive members
+        """
+        for archive in list(self._extractions):
+            self._extract(archive)
+
+    def wait(self, path: str):
+        """
+        Waits until scheduled copy to <path> (if any) is finished,
+        archive member queued for <path> is written first
+        """
+        for archive, queued in self._extractions.items():
+            if path in queued:
+                self._extract(archive)
+                break
+        future = self._pending.pop(path, None)
+        if future is not None:
+            self._settle(path, future)
+
+    def busy(self, path: str, copy: bool = False) -> list[Future]:
+        """
+        Returns scheduled copies an operation on <path> would wait for:
+        the copy to <path>, or all of them if it's a <copy> itself
+        and no worker is free
+        """
+        self._settle_done()
+        if path in self._pending:
+            return [self._pending[path]]
+        if copy and len(self._pending) >= self._capacity:
+            return list(self._pending.values())
+        return []
+
+    def _settle_done(self):
+        for path in [path for path, future in self._pending.items()
+                     if future.done()]:
+            self._settle(path, self._pending.pop(path))
+
+    def _settle(self, path: str, future: Future):
+        done = self._callbacks.pop(path, None)
+        try:
+            strategy = future.result()
+        except Exception as error:
+            self.errors.append((path, error))
+            self._index.remove(path)
+        else:
+            self.strategies[strategy] += 1
+            metrics.count(f"copies_{strategy}")
+            self._index.settle(path)
+            metrics.count('files_copied')
+            # Not from the index, removal of the copy may be planned
+            # already, e.g. when a later source file replaces it
+            metrics.count('bytes_copied', os.path.getsize(path))
+            if done is not None:
+                done()
+
+    def close(self):
+        """
+        Writes queued archive members, waits for all scheduled copies
+        and reports failed ones
+        """
+        self.flush()
+        self._pool.shutdown(wait=True)
+        for path in list(self._pending):
+            self.wait(path)
+        if self.strategies:
+            print("==| Copied files: " + ', '.join(
+                f"{strategy} {count}"
+                for strategy, count in self.strategies.most_common()) + " |==")
+        for path, error in self.errors:
+            print(f"==| Failed to copy {path}: {error} |==")
@@ -0,0 +1,69 @@
+from file_info import FileInfo
+from hasher import Hasher, partial_is_full
+
+SURVIVORS = ('oldest', 'newest')
+
+
+def _group(files: list[FileInfo],
+           digests: list[bytes]) -> list[list[FileInfo]]:
+    """
+    Groups files by size and digest, leaving out files without a pair
+    """
+    groups: dict[tuple[int, bytes], list[FileInfo]] = {}
+    for file, digest in zip(files, digests):
+        groups.setdefault((file.size, digest), []).append(file)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def find_duplicates(files: list[FileInfo],
+                    hasher: Hasher) -> list[list[FileInfo]]:
+    """
+    Returns groups of non-empty files with the same content.
+    Files are grouped by size, then by partial digest, full digest
+    is computed only for larger files. Digests are cached in <hasher>.
+    """
+    by_size: dict[int, list[FileInfo]] = {}
+    for file in files:
+        if file.size:
+            by_size.setdefault(file.size, []).append(file)
+    same_size = [file for group in by_size.values() if len(group) > 1
+                 for file in group]
+
+    digests = hasher.partial_many([(file.path, file.size)
+                                   for file in same_size])
+    for file, digest in zip(same_size, digests):
+        hasher.remember(file.path, file.size, file.mtime, partial=digest)
+    groups = []
+    candidates = []
+    for group in _group(same_size, digests):
+        if partial_is_full(group[0].size):
+            groups.append(group)
+        else:
+            candidates.extend(group)
+
+    digests = hasher.full_many([(file.path, file.size)
+                                for file in candidates])
+    for file, digest in zip(candidates, digests):
+        hasher.remember(file.path, file.size, file.mtime, full=digest)
+    groups.extend(_group(candidates, digests))
+    return groups
+
+
+def find_same_names(files: list[FileInfo]) -> list[list[FileInfo]]:
+    """
+    Returns groups of files with the same name
+    """
+    by_name: dict[str, list[FileInfo]] = {}
+    for file in files:
+        by_name.setdefault(file.name, []).append(file)
+    return [group for group in by_name.values() if len(group) > 1]
+
+
+def choose_survivor(group: list[FileInfo], policy: str) -> FileInfo:
+    """
+    Returns the oldest or the newest file of the group,
+    of files as old the first by path, so the order doesn't matter
+    """
+    choose = min if policy == 'oldest' else max
+    return choose(sorted(group, key=lambda file: file.path),
+                  key=lambda file: file.ctime)
@@ -1,64 +1,747 @@
 import os
-import shutil
+import sys
+import stat
+import queue
+import signal
+import asyncio
+import functools
+import multiprocessing
+from multiprocessing.connection import wait
+from concurrent.futures import ThreadPoolExecutor
 
+from archive import ArchiveMember, is_archive, member_of
 from config import Config
-from checks import CheckDuplicateContent, CheckDuplicateName, CheckEmpty, \
-    CheckName, CheckPermissions, CheckTemporary
+from catalog import Catalog
+from copier import DEDUPE_MODES, CopyExecutor
+from duplicates import choose_survivor, find_duplicates, find_same_names
+from file_info import FileInfo
+from hasher import Hasher
+from index import DestinationIndex
+from journal import SYNC_INTERVAL, Journal
+from metrics import metrics
+from pipeline import DONE, drain, read_batches, run_stages
+from plan import COPIES, Operation, Plan
+from shards import CLAIMS_SUFFIX, Shard, partition
+from walker import Walker
+from watcher import POLL_INTERVAL, ChangeQueue, create_watcher
+from checks import COST_METADATA, CheckDuplicateContent, \
+    CheckDuplicateName, CheckEmpty, CheckName, CheckNearDuplicate, \
+    CheckPermissions, CheckTemporary
+
+PREFETCH_PER_JOB = 4
 
 
 class FileManager:
     """
-    This class is responsible for all file-related actions
+    This class is responsible for all file-related actions.
+    Files flow through asyncio stages connected by bounded queues,
+    so a stage waits whenever the next one falls behind:
+        scan      - walks sources on scan_jobs threads, skips files
+                    already up to date in destination
+        metadata  - runs metadata checks, skips duplicates among sources
+        hash      - submits digests of possible duplicates to the hasher
+        decide    - runs the remaining checks in order, plans operations
+        apply     - applies planned operations, copying on jobs threads
+    Duplicates among sources are known only once all sources are walked,
+    so checks start after the scan, hashing of same-sized files doesn't.
+    A <shard> runs only a partition of sources, see ShardedFileManager.
+    Sources can also be tar or zip archives. An archive is read once
+    when walked, members are hashed as they are streamed, and usually
+    once more, when accepted members are written to destination.
     """
-    def __init__(self, destination: str, source: list[str], config: Config):
+    def __init__(self, destination: str, source: list[str], config: Config,
+                 shard: Shard or None = None):
         self._destination = destination
         self._source = source
+        self._archives = tuple(root for root in source if is_archive(root))
         self._config = config
-        self._checkers = [CheckDuplicateContent(config),
-                          CheckDuplicateName(config),
-                          CheckEmpty(config),
-                          CheckName(config),
-                          CheckPermissions(config),
-                          CheckTemporary(config)]
+        self._shard = shard
+        self._hasher = Hasher(config.hash_algorithm, config.hash_jobs,
+                              config.digest_cache_size)
+        journal = os.path.join(destination, config.journal_name)
+        self._journal = Journal(journal if shard is None
+                                else f"{journal}.{shard.number}")
+        # Journals and claims of all shards share the journal name prefix
+        self._index = DestinationIndex(
+            destination,
+            Catalog(destination, config.catalog_name, config.hash_algorithm,
+                    config.dry_run),
+            self._hasher, ignored=(journal,),
+            scanned=shard.scanned if shard else None)
+        self._resumed: set[str] = set()
+        self._executed = 0
+        self._deferred: list[tuple[FileInfo, int]] = []
+        self._walker = Walker(order=config.walk_order,
+                              symlinks=config.symlinks,
+                              special_files=config.special_files,
+                              exclude=shard.exclude if shard else frozenset(),
+                              read=functools.partial(
+                                  self._hasher.stream,
+                                  fingerprints=bool(config.near_duplicates)))
+        self._plan = Plan(destination, self._index)
+        self._copier = CopyExecutor(self._index, config.jobs,
+                                    config.copy_mode, self._archives)
+        checker_args = (config, self._index, self._plan)
+        self._checkers = [CheckDuplicateContent(*checker_args),
+                          CheckDuplicateName(*checker_args),
+                          CheckEmpty(*checker_args),
+                          CheckName(*checker_args),
+                          CheckPermissions(*checker_args),
+                          CheckTemporary(*checker_args)]
+        if config.near_duplicates:
+            self._checkers.append(CheckNearDuplicate(*checker_args))
+        self._checkers.sort(key=lambda checker: checker.cost)
+        self._metadata_checks = sum(checker.cost == COST_METADATA
+                                    for checker in self._checkers)
 
-    def _check_file(self, path: str) -> bool:
+    def _check_file(self, file: FileInfo, first: int = 0,
+                    stop: int or None = None,
+                    resolve: bool = False) -> bool or None:
         """
-        Checks the file and returns True if the file can be copied
+        Checks the file, cheapest checks first, and returns True
+        if the file can be copied. Stops at the first rejection.
+        Files that need user decision are deferred and None is returned.
         """
-        can_be_copied = True
-        for checker in self._checkers:
-            checker_result = checker.check(path)
-            can_be_copied = can_be_copied and checker_result
+        if stop is None:
+            stop = len(self._checkers)
+        for position in range(first, stop):
+            result = self._checkers[position].check(file, resolve)
+            if result is None:
+                self._deferred.append((file, position))
+                return None
+            if not result:
+                return False
+        return True
+
+    def _find_duplicates(self, files: list[FileInfo]) -> set[str]:
+        """
+        Groups files with the same content across all sources and
+        returns paths of all but one survivor of every group
+        """
+        duplicates: set[str] = set()
+        for group in find_duplicates(files, self._hasher):
+            survivor = choose_survivor(group, self._config.duplicate_survivor)
+            duplicates.update(file.path for file in group
+                              if file is not survivor)
+        return duplicates
+
+    def _find_same_names(self, files: list[FileInfo]) -> set[str]:
+        """
+        Groups files with the same name across all sources and
+        returns paths of all but the newest of every group
+        """
+        conflicts: set[str] = set()
+        for group in find_same_names(files):
+            survivor = choose_survivor(group, 'newest')
+            conflicts.update(file.path for file in group
+                             if file is not survivor)
+        return conflicts
+
+    def _is_current(self, file: FileInfo) -> bool:
+        """
+        Quick check: returns True if destination already has the file
+        under its relative path, possibly with dangerous characters
+        replaced, with the same size and mtime (content with checksum)
+        """
+        names = {file.name, file.name.translate(self._config.name_translation)}
+        return any(self._index.is_current(
+            self._plan.target_path(file.path, name), file,
+            self._config.checksum) for name in names)
+
+    def _skip_current(self, file: FileInfo) -> bool:
+        """
+        Plans skip of file that is already up to date, before any check
+        """
+        if not self._is_current(file):
+            return False
+        metrics.count('files_up_to_date')
+        self._plan.skip(file)
+        return True
+
+    def _copy_file(self, file: FileInfo):
+        """
+        Plans copy of file from source to path relative to destination folder
+        """
+        self._plan.copy(file)
+
+    def _finish_file(self, file: FileInfo, result: bool or None):
+        """
+        Plans copy or skip of checked file, deferred files are left
+        for resolve
+        """
+        if result:
+            self._copy_file(file)
+        elif result is not None:
+            self._plan.skip(file)
+        self._hasher.discard(file.path)
+
+    async def plan(self):
+        """
+        Walks through all sources, skips duplicates among them
+        and checks every other file, filling the operation plan
+        """
+        with metrics.timer('scan_sources'):
+            files = await self._scan()
+        await self._plan_files(files)
+
+    async def _skip_conflicts(self, files: list[FileInfo]) -> list[FileInfo]:
+        """
+        Skips files conflicting with files of other shards
+        """
+        loop = asyncio.get_running_loop()
+        losers = await loop.run_in_executor(
+            None, self._shard.resolve, files, self._hasher,
+            self._config.duplicate_survivor)
+        if losers:
+            print(f"==| Skipping {len(losers)} files conflicting"
+                  " with other shards |==")
+        kept = []
+        for file in files:
+            if file.path in losers:
+                self._finish_file(file, False)
+            else:
+                kept.append(file)
+        return kept
+
+    async def _scan(self) -> list[FileInfo]:
+        """
+        Walks sources in parallel and returns their files in source order.
+        Files of the same size are submitted for partial hashing
+        as they are found, duplicates among sources need it.
+        Files already up to date are skipped before that.
+        """
+        found: list[list[FileInfo]] = [[] for _ in self._source]
+        by_size: dict[int, FileInfo] = {}
+        current = 0
+        queue = asyncio.Queue(self._config.queue_size)
+
+        async def walk(number: int, root: str, pool: ThreadPoolExecutor):
+            async for batch in read_batches(self._walker.walk(root), pool):
+                await queue.put((number, batch))
+
+        async def scan():
+            with ThreadPoolExecutor(self._config.scan_jobs) as pool:
+                try:
+                    await run_stages(*(walk(number, root, pool)
+                                       for number, root
+                                       in enumerate(self._source)))
+                finally:
+                    await queue.put(DONE)
+
+        async def collect():
+            nonlocal current
+            async for number, batch in drain(queue):
+                for file in batch:
+                    if file.path in self._resumed:
+                        continue
+                    if self._skip_current(file):
+                        current += 1
+                        continue
+                    found[number].append(file)
+                    if not file.size:
+                        continue
+                    first = by_size.setdefault(file.size, file)
+                    if first is not file:
+                        self._hasher.prefetch(first.path, first.size,
+                                              first.mtime)
+                        self._hasher.prefetch(file.path, file.size,
+                                              file.mtime)
 
-        return can_be_copied
+        await run_stages(scan(), collect())
+        if current:
+            print(f"==| Skipping {current} files up to date"
+                  " in destination |==")
+        return [file for files in found for file in files]
+
+    async def _plan_files(self, files: list[FileInfo]):
+        """
+        Checks files in stages and applies decided operations
+        as soon as they are planned, unless dry run
+        """
+        checked = asyncio.Queue(self._config.queue_size)
+        hashed = asyncio.Queue(PREFETCH_PER_JOB * self._config.hash_jobs)
+        decided = asyncio.Queue(self._config.queue_size)
+        stages = [self._check_metadata(files, checked),
+                  self._hash(checked, hashed),
+                  self._decide(hashed, decided)]
+        if not self._config.dry_run:
+            stages.append(self._apply_stage(decided))
+        await run_stages(*stages)
+
+    async def _check_metadata(self, files: list[FileInfo],
+                              checked: asyncio.Queue):
+        """
+        Runs checks using only metadata, then skips duplicates and
+        older files with the same name among files that passed them,
+        so a rejected file never survives instead of its duplicate.
+        Passes files that weren't decided about yet. Shards skip
+        conflicts with files of all shards by the same rules instead.
+        """
+        loop = asyncio.get_running_loop()
+        # Nobody is asked in batch mode, so files are decided about right
+        # away and conflicts are found among all files that pass, the same
+        # with shards, which run in batch mode only
+        resolve = self._config.batchmode
+        passed = []
+        for file in files:
+            metrics.count('files_checked')
+            result = self._check_file(file, stop=self._metadata_checks,
+                                      resolve=resolve)
+            if result:
+                passed.append(file)
+            else:
+                self._finish_file(file, result)
+        duplicates: set[str] = set()
+        conflicts: set[str] = set()
+        if self._shard is not None:
+            passed = await self._skip_conflicts(passed)
+        else:
+            if not self._config.dedupe:
+                # In dedupe mode duplicates are linked to the first copy
+                duplicates = await loop.run_in_executor(
+                    None, self._find_duplicates, passed)
+            conflicts = self._find_same_names(
+                [file for file in passed if file.path not in duplicates])
+        if duplicates:
+            print(f"==| Skipping {len(duplicates)} duplicates"
+                  " found in sources |==")
+        if conflicts:
+            print(f"==| Skipping {len(conflicts)} older files with names"
+                  " found in sources |==")
+        for file in passed:
+            if file.path in duplicates or file.path in conflicts:
+                self._finish_file(file, False)
+            else:
+                await checked.put(file)
+        await checked.put(DONE)
+
+    async def _hash(self, checked: asyncio.Queue, hashed: asyncio.Queue):
+        """
+        Submits files that may have duplicates in destination
+        for partial hashing, the bounded queue keeps a few files ahead.
+        Larger files are compared only with partial matches later.
+        """
+        async for file in drain(checked):
+            if file.size and self._index.has_size(file.size):
+                self._hasher.prefetch(file.path, file.size, file.mtime)
+            await hashed.put(file)
+        await hashed.put(DONE)
+
+    async def _decide(self, hashed: asyncio.Queue, decided: asyncio.Queue):
+        """
+        Runs remaining checks once digests of the file are ready,
+        in source order, and passes on decided files
+        """
+        async for file in drain(hashed):
+            pending = self._hasher.pending(file.path)
+            if pending:
+                await asyncio.wait([asyncio.wrap_future(future)
+                                    for future in pending])
+            self._finish_file(file, self._check_file(
+                file, self._metadata_checks))
+            if not self._config.dry_run:
+                await decided.put(file)
+        await decided.put(DONE)
+
+    async def _apply_stage(self, decided: asyncio.Queue):
+        """
+        Applies operations planned for decided files, journaled
+        in batches, so the journal isn't synced for every file
+        """
+        async for _ in drain(decided):
+            if len(self._plan.operations) - self._executed >= SYNC_INTERVAL:
+                await self._apply_batch()
+        await self._apply_batch()
+
+    async def _apply_batch(self):
+        """
+        Applies operations planned since the last call in order,
+        waiting for copies they depend on, or for a free copy worker,
+        without blocking other stages
+        """
+        operations = self._take_operations()
+        if not operations:
+            return
+        self._plan.commit(operations)
+        numbers = self._journal.plan(operations)
+        applied = 0
+        try:
+            for seq, operation in zip(numbers, operations):
+                copy = operation.kind in COPIES
+                path = operation.origin or \
+                    (operation.target if copy else operation.path)
+                while busy := self._copier.busy(path, copy):
+                    await asyncio.wait([asyncio.wrap_future(future)
+                                        for future in busy],
+                                       return_when=asyncio.FIRST_COMPLETED)
+                self._execute(seq, operation)
+                applied += 1
+        except asyncio.CancelledError:
+            # The batch is already taken and journaled, the rest of it
+            # is applied without waiting, e.g. directories copies need
+            for seq, operation in zip(numbers[applied:],
+                                      operations[applied:]):
+                self._execute(seq, operation)
+            raise
 
-    def _bfs_dir_structure(self, path: str):
+    def resolve(self):
         """
-        Allows to iterate through folder structure
+        Resolves deferred conflicts all at once, continuing checks
+        of every deferred file with the check that deferred it
         """
-        for filename in os.listdir(path):
-            new_path = os.path.join(path, filename)
-            if os.path.isfile(new_path):
-                if self._check_file(new_path):
-                    self._copy_file(new_path)
+        if not self._deferred:
+            return
+        print(f"==| Resolving {len(self._deferred)} deferred conflicts |==")
+        deferred, self._deferred = self._deferred, []
+        for file, position in deferred:
+            if self._checkers[position].resolve(file) and \
+                    self._check_file(file, position + 1, resolve=True):
+                self._copy_file(file)
             else:
-                self._bfs_dir_structure(path=new_path)
+                self._plan.skip(file)
 
-    def _copy_file(self, path: str):
+    async def watch(self):
         """
-        Copies file from source to path relative to destination folder
+        Watches sources for created and modified files, checks
+        and copies them once they are written. Stops on Ctrl+C.
         """
-        destination_path = self._destination
-        for level in path.split(os.sep)[:-1]:
-            destination_path = os.path.join(destination_path, level)
-            if not os.path.exists(destination_path):
-                os.mkdir(destination_path)
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        # Archives don't change while being copied
+        watcher = create_watcher([root for root in self._source
+                                  if root not in self._archives],
+                                 self._walker)
+        queue = ChangeQueue()
+        print("==| Watching sources, press Ctrl+C to stop |==")
+        try:
+            loop.add_signal_handler(signal.SIGINT, stop.set)
+            handled = True
+        except NotImplementedError:
+            # Not supported on Windows, Ctrl+C interrupts the run there
+            handled = False
+        try:
+            while not stop.is_set():
+                # Wake up regularly to notice Ctrl+C
+                timeout = queue.timeout()
+                timeout = POLL_INTERVAL if timeout is None \
+                    else min(timeout, POLL_INTERVAL)
+                for path in await loop.run_in_executor(
+                        None, watcher.changes, timeout):
+                    queue.push(path)
+                files = []
+                for path in queue.pop_ready():
+                    try:
+                        file = FileInfo.from_path(path)
+                    except OSError:
+                        # Removed before it was processed
+                        continue
+                    if stat.S_ISREG(file.mode) and \
+                            not self._skip_current(file):
+                        files.append(file)
+                if files:
+                    await self._plan_files(files)
+                    self.resolve()
+                    self._apply()
+        finally:
+            if handled:
+                loop.remove_signal_handler(signal.SIGINT)
+            watcher.close()
 
-        shutil.copy(src=path, dst=destination_path)
+    def resume(self):
+        """
+        Replays journal of an interrupted run: pending operations are
+        planned again and files it decided about aren't checked again
+        """
+        completed, pending = self._journal.load()
+        if not self._config.dry_run:
+            self._journal.open(completed)
+        for operation in completed + pending:
+            if operation.kind in COPIES or operation.kind == 'skip':
+                self._resumed.add(operation.path)
+        self._replay(pending)
+        print(f"==| Resuming: {len(completed)} operations done,"
+              f" {len(pending)} pending |==")
+
+    def load(self):
+        """
+        Plans operations of a plan saved by an earlier run, usually
+        a dry run, so they are applied as reviewed, without checks
+        """
+        operations = self._config.saved_operations
+        self._replay(operations)
+        print(f"==| Executing {len(operations)} operations"
+              f" of plan {self._config.execute_file} |==")
+
+    def _replay(self, operations: list[Operation]):
+        """
+        Plans <operations> again, copies of source files
+        that can't be stat'ed anymore are left out with their chmod
+        """
+        failed: set[str] = set()
+        for operation in operations:
+            if operation.kind == 'chmod' and operation.path in failed:
+                continue
+            origin = None
+            if operation.kind in COPIES and \
+                    member_of(operation.path, self._archives):
+                # Members can't be stat'ed, they are written again
+                # once their archive is walked
+                origin = ArchiveMember(operation.path, operation.size,
+                                       stat.S_IFREG, 0)
+            try:
+                self._plan.replay(operation, origin)
+            except OSError as error:
+                print(f"==| Can't replay {operation.kind} of"
+                      f" {operation.path}: {error} |==")
+                failed.add(operation.target)
+
+    def execute(self, operations: list[Operation]):
+        """
+        Applies planned operations, all destination directories
+        are created up front. Operations are journaled.
+        """
+        numbers = self._journal.plan(operations)
+        for seq, operation in zip(numbers, operations):
+            if operation.kind == 'mkdir':
+                self._execute(seq, operation)
+        for seq, operation in zip(numbers, operations):
+            if operation.kind != 'mkdir':
+                self._execute(seq, operation)
+
+    def _execute(self, seq: int, operation: Operation):
+        """
+        Applies single journaled operation, copies are only scheduled
+        """
+        if operation.kind == 'mkdir':
+            os.makedirs(operation.path, exist_ok=True)
+            self._journal.complete(seq)
+        elif operation.kind in ('copy', 'copy_as', 'delta'):
+            self._copier.copy(
+                operation.path, operation.target,
+                done=functools.partial(self._journal.complete, seq),
+                basis=operation.origin)
+            if operation.origin not in ('', operation.target):
+                # Delta copy removes the file it replaces
+                self._index.forget(operation.origin)
+        elif operation.kind in DEDUPE_MODES:
+            self._copier.link(
+                operation.origin, operation.path, operation.target,
+                operation.kind,
+                done=functools.partial(self._journal.complete, seq))
+        elif operation.kind == 'chmod':
+            self._copier.chmod(
+                operation.path, operation.mode,
+                done=functools.partial(self._journal.complete, seq))
+        elif operation.kind == 'delete':
+            self._copier.discard(operation.path)
+            self._copier.wait(operation.path)
+            try:
+                os.remove(operation.path)
+            except FileNotFoundError:
+                # Already removed by an interrupted run
+                pass
+            self._index.forget(operation.path)
+            self._journal.complete(seq)
+        elif operation.kind == 'skip':
+            self._journal.complete(seq)
+
+    def _take_operations(self) -> list[Operation]:
+        """
+        Returns operations planned since the last call
+        """
+        operations = self._plan.operations[self._executed:]
+        self._executed = len(self._plan.operations)
+        return operations
+
+    def _apply(self):
+        """
+        Applies operations planned since the last call, unless dry run
+        """
+        if self._config.dry_run:
+            return
+        operations = self._take_operations()
+        self._plan.commit(operations)
+        self.execute(operations)
+
+    def _report_checks(self):
+        """
+        Prints number of checked files, hits and time spent per checker
+        """
+        for checker in self._checkers:
+            print(f"==| {checker.name:<20}: {checker.invocations} checked,"
+                  f" {checker.hits} hits, {checker.time_spent:.3f}s |==")
+
+    def totals(self) -> dict[str, int]:
+        """
+        Returns totals of the operation plan
+        """
+        return self._plan.totals()
+
+    def _report_plan(self):
+        """
+        Prints totals of the operation plan
+        """
+        totals = self.totals()
+        print(f"==| Plan: {totals['copy'] + totals['copy_as']} files to copy"
+              f" ({totals['bytes']} bytes),"
+              f" {totals['delta']} to update by delta,"
+              f" {totals['hardlink'] + totals['reflink']} to link,"
+              f" {totals['delete']} to delete,"
+              f" {totals['chmod']} to chmod, {totals['mkdir']} directories"
+              f" to create, {totals['skip']} skipped |==")
 
     def start(self):
         """
-        Starts the script
+        Starts the script, runs it on a new event loop.
+        Exits once a run stopped by SIGTERM is wound up
+        """
+        try:
+            asyncio.run(self.run())
+        except asyncio.CancelledError:
+            sys.exit(-1)
+
+    async def run(self):
+        """
+        Plans operations and applies them as soon as they are decided.
+        Files without conflicts are copied before deferred conflicts
+        are resolved. Operations planned before quitting are applied too
+        and the journal is kept, so the run can be resumed.
+        A plan saved earlier is applied instead, if one is given.
+        In watch mode sources are watched for new files afterwards.
+        """
+        finished = False
+        loop = asyncio.get_running_loop()
+        terminate = signal.getsignal(signal.SIGTERM)
+        try:
+            # Stops the run at its next await, like Ctrl+C stops watching
+            loop.add_signal_handler(signal.SIGTERM,
+                                    asyncio.current_task().cancel)
+            handled = True
+        except NotImplementedError:
+            # Not supported on Windows, the handler from main is kept
+            handled = False
+        try:
+            if self._config.resume:
+                self.resume()
+            elif not self._config.dry_run:
+                self._journal.open()
+            if self._config.execute_file:
+                self.load()
+            else:
+                await self.plan()
+            self._apply()
+            self.resolve()
+            if self._config.watch:
+                self._apply()
+                # Archives aren't watched, no more members will be queued
+                self._copier.flush()
+                await self.watch()
+            finished = True
+        finally:
+            self._hasher.close()
+            self._report_checks()
+            try:
+                if self._config.plan_file:
+                    self._plan.save(self._config.plan_file)
+                if self._config.dry_run:
+                    self._report_plan()
+                else:
+                    self._apply()
+            finally:
+                self._copier.close()
+                self._journal.close(finished)
+                self._index.close()
+                if handled:
+                    loop.remove_signal_handler(signal.SIGTERM)
+                    signal.signal(signal.SIGTERM, terminate)
+
+
+def run_shard(destination: str, units: list[str], config: Config,
+              shard: Shard, results: multiprocessing.Queue):
+    """
+    Runs FileManager on one partition of sources in a worker process
+    and puts totals of its plan and its metrics to <results>
+    """
+    metrics.reset()
+    file_manager = FileManager(destination, units, config, shard)
+    file_manager.start()
+    results.put((file_manager.totals(), metrics.snapshot()['counters']))
+
+
+class ShardedFileManager:
+    """
+    Runs FileManager on partitions of sources in config.shards worker
+    processes, so checking and copying scales with cores and disks.
+    Destination is walked and its catalog brought up to date before
+    workers start, workers index it from there without walking it again,
+    share the catalog and resolve conflicts between their files
+    through claims, see Shard. Runs in batch mode only.
+    """
+    def __init__(self, destination: str, source: list[str], config: Config):
+        self._destination = destination
+        self._source = source
+        self._config = config
+        self._totals: dict[str, int] = {}
+
+    def start(self):
+        """
+        Starts workers and waits for them, if any of them fails
+        the others are stopped waiting for its claims
+        """
+        journal = os.path.join(self._destination, self._config.journal_name)
+        hasher = Hasher(self._config.hash_algorithm)
+        index = DestinationIndex(
+            self._destination,
+            Catalog(self._destination, self._config.catalog_name,
+                    self._config.hash_algorithm, self._config.dry_run),
+            hasher, ignored=(journal,))
+        scanned = index.files()
+        index.close()
+        hasher.close()
+
+        partitions, excluded = partition(self._source, self._config.shards)
+        print(f"==| Running {len(partitions)} shards |==")
+        claims = journal + CLAIMS_SUFFIX
+        Shard.create(claims)
+        barrier = multiprocessing.Barrier(len(partitions))
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(
+            target=run_shard,
+            args=(self._destination, units, self._config,
+                  Shard(number, claims, barrier, excluded, scanned),
+                  results))
+            for number, units in enumerate(partitions)]
+        try:
+            for worker in workers:
+                worker.start()
+            running = {worker.sentinel: worker for worker in workers}
+            while running:
+                for sentinel in wait(list(running)):
+                    if running.pop(sentinel).exitcode:
+                        barrier.abort()
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+            Shard.remove(claims)
+        failed = [number for number, worker in enumerate(workers)
+                  if worker.exitcode]
+        while True:
+            try:
+                totals, counters = results.get(timeout=1)
+            except queue.Empty:
+                break
+            for name, value in totals.items():
+                self._totals[name] = self._totals.get(name, 0) + value
+            for name, value in counters.items():
+                metrics.count(name, value)
+        if failed:
+            raise RuntimeError(
+                f"shards {', '.join(map(str, failed))} failed")
+
+    def totals(self) -> dict[str, int]:
+        """
+        Returns totals of operation plans of all shards
         """
-        for path in self._source:
-            self._bfs_dir_structure(path=path)
+        return self._totals
@@ -0,0 +1,389 @@
+import mmap
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, \
+    ThreadPoolExecutor
+from typing import BinaryIO
+
+from file_info import FileInfo
+from metrics import metrics
+from similarity import Fingerprint, fingerprint
+
+ALGORITHMS = ('blake2b', 'sha256')
+PARTIAL_BLOCK_SIZE = 64 * 1024
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+MAP_CHUNK_SIZE = 16
+DIGEST_CACHE_SIZE = 65536
+
+
+def partial_digest(path: str, size: int, algorithm: str) -> bytes:
+    """
+    Hashes the first and the last block of the file
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as file:
+        digest.update(file.read(PARTIAL_BLOCK_SIZE))
+        if size > PARTIAL_BLOCK_SIZE:
+            file.seek(max(size - PARTIAL_BLOCK_SIZE, PARTIAL_BLOCK_SIZE))
+            digest.update(file.read(PARTIAL_BLOCK_SIZE))
+    return digest.digest()
+
+
+def partial_size(size: int) -> int:
+    """
+    Returns number of bytes read by partial digest of the file
+    """
+    return min(size, 2 * PARTIAL_BLOCK_SIZE)
+
+
+def partial_is_full(size: int) -> bool:
+    """
+    Returns True if partial digest of the file covers its whole content,
+    so files of <size> bytes are compared by partial digests alone
+    """
+    return size <= 2 * PARTIAL_BLOCK_SIZE
+
+
+def full_digest(path: str, algorithm: str) -> bytes:
+    """
+    Hashes the whole content of the file reading it in large blocks
+    """
+    digest = hashlib.new(algorithm)
+    buffer = bytearray(READ_BLOCK_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as file:
+        while read := file.readinto(buffer):
+            digest.update(view[:read])
+    return digest.digest()
+
+
+def stream_digests(content: BinaryIO, size: int, algorithm: str,
+                   fingerprints: bool = False) -> tuple[bytes, bytes, bytes]:
+    """
+    Returns partial digest, full digest and, with <fingerprints>,
+    similarity signature of <size> bytes of <content> read once
+    in large blocks, for streams that can't be read again
+    """
+    partial, full = hashlib.new(algorithm), hashlib.new(algorithm)
+    signature = Fingerprint() if fingerprints else None
+    tail = max(size - PARTIAL_BLOCK_SIZE, PARTIAL_BLOCK_SIZE)
+    offset = 0
+    while block := content.read(READ_BLOCK_SIZE):
+        full.update(block)
+        # Same blocks as partial_digest reads, the first and the last one
+        if offset < PARTIAL_BLOCK_SIZE:
+            partial.update(block[:PARTIAL_BLOCK_SIZE - offset])
+        if size > PARTIAL_BLOCK_SIZE and offset + len(block) > tail:
+            partial.update(block[max(tail - offset, 0):])
+        if signature is not None:
+            signature.update(block)
+        offset += len(block)
+    return partial.digest(), full.digest(), \
+        signature.digest() if signature is not None else b''
+
+
+def _compare_reads(path: str, other: str) -> bool:
+    """
+    Compares content of two files reading them in large blocks
+    """
+    buffer, other_buffer = bytearray(READ_BLOCK_SIZE), \
+        bytearray(READ_BLOCK_SIZE)
+    with open(path, 'rb', buffering=0) as file, \
+            open(other, 'rb', buffering=0) as other_file:
+        while True:
+            read = file.readinto(buffer)
+            if read != other_file.readinto(other_buffer) or \
+                    buffer[:read] != other_buffer[:read]:
+                return False
+            if not read:
+                return True
+
+
+def same_content(path: str, other: str, size: int) -> bool:
+    """
+    Compares content of two files of <size> bytes mapped to memory,
+    block by block, stopping at the first block that differs.
+    Files that can't be mapped are compared by reading them.
+    """
+    if not size:
+        return True
+    with open(path, 'rb') as file, open(other, 'rb') as other_file:
+        try:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return _compare_reads(path, other)
+        try:
+            other_data = mmap.mmap(other_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            data.close()
+            return _compare_reads(path, other)
+        with data, other_data:
+            if len(data) != len(other_data):
+                return False
+            for mapped in (data, other_data):
+                if hasattr(mapped, 'madvise'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+            for offset in range(0, len(data), READ_BLOCK_SIZE):
+                end = offset + READ_BLOCK_SIZE
+                if data[offset:end] != other_data[offset:end]:
+                    return False
+    return True
+
+
+class DigestCache:
+    """
+    Digests of at most <capacity> least recently used files
+    by (path, size, mtime), so memory stays constant over long runs
+    and a changed file is never matched to its old digest
+    """
+    def __init__(self, capacity: int = DIGEST_CACHE_SIZE):
+        self._capacity = capacity
+        self._digests: OrderedDict[tuple[str, int, int], bytes] = \
+            OrderedDict()
+
+    def get(self, key: tuple[str, int, int]) -> bytes:
+        """
+        Returns cached digest or empty bytes if there is none
+        """
+        digest = self._digests.get(key)
+        if digest is None:
+            return b''
+        self._digests.move_to_end(key)
+        metrics.count('digest_cache_hits')
+        return digest
+
+    def put(self, key: tuple[str, int, int], digest: bytes):
+        """
+        Caches digest, evicting the least recently used one if full
+        """
+        self._digests[key] = digest
+        self._digests.move_to_end(key)
+        if len(self._digests) > self._capacity:
+            self._digests.popitem(last=False)
+            metrics.count('digest_cache_evictions')
+
+
+class Hasher:
+    """
+    Computes content digests, on a pool of worker processes if jobs > 1,
+    on a single worker thread otherwise. Source files can be submitted
+    ahead of the checks, so digests are usually ready by the time
+    duplicate detection asks for them. Digests of files whose <mtime>
+    is given are kept in bounded caches after the file is discarded.
+    Files that can be read only once, like archive members, are digested
+    as they are streamed and their digests are kept for the whole run.
+    """
+    def __init__(self, algorithm: str = 'blake2b', jobs: int = 1,
+                 cache_size: int = DIGEST_CACHE_SIZE):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(
+                f"{algorithm} is not one of {', '.join(ALGORITHMS)}.")
+        self.algorithm = algorithm
+        self._pool = ProcessPoolExecutor(max_workers=jobs) \
+            if jobs > 1 else ThreadPoolExecutor(max_workers=1)
+        self._partial: dict[str, Future] = {}
+        self._full: dict[str, Future] = {}
+        self._partial_cache = DigestCache(cache_size)
+        self._full_cache = DigestCache(cache_size)
+        self._fingerprint_cache = DigestCache(cache_size)
+        self._streamed: dict[str, tuple[bytes, bytes, bytes]] = {}
+
+    def stream(self, file: FileInfo, content: BinaryIO,
+               fingerprints: bool = False):
+        """
+        Computes digests and, with <fingerprints>, similarity signature
+        of the file from its streamed <content>
+        """
+        metrics.count('bytes_hashed', file.size)
+        self._streamed[file.path] = stream_digests(
+            content, file.size, self.algorithm, fingerprints)
+
+    def prefetch(self, path: str, size: int, mtime: int or None = None,
+                 full: bool = False):
+        """
+        Starts hashing of the file in background, unless cached
+        """
+        if path in self._streamed:
+            return
+        if mtime is not None:
+            for futures, cache in ((self._partial, self._partial_cache),
+                                   (self._full, self._full_cache)):
+                digest = cache.get((path, size, mtime))
+                if digest:
+                    self._remember(futures, path, digest)
+        if path not in self._partial:
+            metrics.count('bytes_hashed', partial_size(size))
+            self._partial[path] = self._pool.submit(
+                partial_digest, path, size, self.algorithm)
+        if full and path not in self._full:
+            metrics.count('bytes_hashed', size)
+            self._full[path] = self._pool.submit(
+                full_digest, path, self.algorithm)
+
+    @staticmethod
+    def _remember(futures: dict[str, Future], path: str, digest: bytes):
+        future = Future()
+        future.set_result(digest)
+        futures[path] = future
+
+    def remember(self, path: str, size: int, mtime: int,
+                 partial: bytes = b'', full: bytes = b''):
+        """
+        Caches digests of the file computed ahead
+        """
+        key = (path, size, mtime)
+        if partial:
+            self._partial_cache.put(key, partial)
+        if full:
+            self._full_cache.put(key, full)
+
+    def pending(self, path: str) -> list[Future]:
+        """
+        Returns futures of digests of the file submitted so far
+        """
+        return [futures[path] for futures in (self._partial, self._full)
+                if path in futures]
+
+    def discard(self, path: str):
+        """
+        Forgets prefetched digests of the file
+        """
+        for futures in (self._partial, self._full):
+            future = futures.pop(path, None)
+            if future is not None:
+                future.cancel()
+
+    def partial(self, path: str, size: int,
+                mtime: int or None = None) -> bytes:
+        """
+        Returns partial digest of the file, prefetched or cached
+        if available
+        """
+        if path in self._streamed:
+            return self._streamed[path][0]
+        future = self._partial.get(path)
+        if future is not None:
+            return future.result()
+        key = (path, size, mtime)
+        digest = self._partial_cache.get(key) if mtime is not None else b''
+        if not digest:
+            metrics.count('bytes_hashed', partial_size(size))
+            digest = partial_digest(path, size, self.algorithm)
+            if mtime is not None:
+                self._partial_cache.put(key, digest)
+        return digest
+
+    def full(self, path: str, size: int, mtime: int or None = None) -> bytes:
+        """
+        Returns full digest of the file, prefetched or cached if available
+        """
+        if path in self._streamed:
+            return self._streamed[path][1]
+        future = self._full.get(path)
+        if future is not None:
+            return future.result()
+        key = (path, size, mtime)
+        digest = self._full_cache.get(key) if mtime is not None else b''
+        if not digest:
+            metrics.count('bytes_hashed', size)
+            digest = full_digest(path, self.algorithm)
+            if mtime is not None:
+                self._full_cache.put(key, digest)
+        return digest
+
+    def known_full(self, path: str, size: int, mtime: int) -> bytes:
+        """
+        Returns full digest of the file if it was already computed,
+        empty bytes otherwise
+        """
+        if path in self._streamed:
+            return self._streamed[path][1]
+        future = self._full.get(path)
+        if future is not None and future.done() and not future.cancelled():
+            return future.result()
+        return self._full_cache.get((path, size, mtime))
+
+    def fingerprint(self, path: str, size: int, mtime: int) -> bytes:
+        """
+        Returns similarity signature of the file, cached if available
+        """
+        if path in self._streamed:
+            return self._streamed[path][2]
+        key = (path, size, mtime)
+        signature = self._fingerprint_cache.get(key)
+        if not signature:
+            metrics.count('bytes_fingerprinted', size)
+            signature = fingerprint(path)
+            self._fingerprint_cache.put(key, signature)
+        return signature
+
+    def fingerprint_many(self, files: list[tuple[str, int]]) -> list[bytes]:
+        """
+        Returns similarity signatures of (path, size) pairs,
+        those not streamed are computed in parallel
+        """
+        missing = [(path, size) for path, size in files
+                   if path not in self._streamed]
+        metrics.count('bytes_fingerprinted',
+                      sum(size for _, size in missing))
+        signatures = dict(zip([path for path, _ in missing], self._pool.map(
+            fingerprint, [path for path, _ in missing],
+            chunksize=MAP_CHUNK_SIZE)))
+        return [signatures[path] if path in signatures
+                else self._streamed[path][2] for path, _ in files]
+
+    def compare(self, path: str, other: str, size: int) -> bool:
+        """
+        Returns True if two files of <size> bytes have the same content
+        """
+        if path in self._streamed or other in self._streamed:
+            # Streamed content can't be read again, its digest is known
+            return self.full(path, size) == self.full(other, size)
+        metrics.count('files_compared')
+        return same_content(path, other, size)
+
+    def partial_many(self, files: list[tuple[str, int]]) -> list[bytes]:
+        """
+        Returns partial digests of (path, size) pairs,
+        those not prefetched are hashed in parallel
+        """
+        missing = [(path, size) for path, size in files
+                   if path not in self._partial
+                   and path not in self._streamed]
+        digests: dict[str, bytes] = {}
+        if len(missing) > 1:
+            paths = [path for path, _ in missing]
+            sizes = [size for _, size in missing]
+            metrics.count('bytes_hashed', sum(map(partial_size, sizes)))
+            digests = dict(zip(paths, self._pool.map(
+                partial_digest, paths, sizes, [self.algorithm] * len(paths),
+                chunksize=MAP_CHUNK_SIZE)))
+        return [digests[path] if path in digests
+                else self.partial(path, size) for path, size in files]
+
+    def full_many(self, files: list[tuple[str, int]]) -> list[bytes]:
+        """
+        Returns full digests of (path, size) pairs,
+        those not prefetched are hashed in parallel
+        """
+        missing = [(path, size) for path, size in files
+                   if path not in self._full and path not in self._streamed]
+        digests: dict[str, bytes] = {}
+        if len(missing) > 1:
+            paths = [path for path, _ in missing]
+            metrics.count('bytes_hashed', sum(size for _, size in missing))
+            digests = dict(zip(paths, self._pool.map(
+                full_digest, paths, [self.algorithm] * len(paths),
+                chunksize=MAP_CHUNK_SIZE)))
+        return [digests[path] if path in digests
+                else self.full(path, size) for path, size in files]
+
+    def close(self):
+        """
+        Stops the workers
+        """
+        for futures in (self._partial, self._full):
+            for future in futures.values():
+                future.cancel()
+        self._pool.shutdown(wait=True)
@@ -6,7 +6,9 @@ dirname = os.path.dirname(__file__)
 MAIN_DIR = os.path.join(dirname, 'X')
 SUB_DIR_1 = os.path.join(dirname, 'Y1')
 SUB_DIR_1_SUB_DIR = os.path.join(SUB_DIR_1, 'y')
+SUB_DIR_1_LOGS = os.path.join(SUB_DIR_1, 'logs')
 SUB_DIR_2 = os.path.join(dirname, 'Y2')
+SUB_DIR_2_LOGS = os.path.join(SUB_DIR_2, 'logs')
 SUB_DIR_3 = os.path.join(dirname, 'Y3')
 
 
@@ -36,6 +38,14 @@ def clean_contents(folder: str):
             print('Failed to delete %s. Reason: %s' % (file_path, e))
 
 
+# Near duplicates, differing only in the header line. Run on their
+# folders alone, the copy of the first one is still in flight
+# when the second one replaces it:
+# main.py X Y1/logs Y2/logs -b --near-duplicates 0.8
+LOG_LINES = ''.join(f"2023-01-01 line {i} value {i * 7919 % 10007}\n"
+                    for i in range(200))
+
+
 if __name__ == "__main__":
     # Clean
     for folder in (MAIN_DIR, SUB_DIR_1, SUB_DIR_2, SUB_DIR_3):
@@ -49,6 +59,8 @@ if __name__ == "__main__":
     write_file(SUB_DIR_1, 'temporary', 'tmp', 'temporary')
     write_file(SUB_DIR_1, 'empty', 'empty', '')
     write_file(SUB_DIR_1, '1', 'txt', 'Hello from y1 subfolder.')
+    os.mkdir(SUB_DIR_1_LOGS)
+    write_file(SUB_DIR_1_LOGS, 'events', 'log', '# exported\n' + LOG_LINES)
     os.mkdir(SUB_DIR_1_SUB_DIR)
     write_file(SUB_DIR_1_SUB_DIR, 'same_content', 'txt', 'same content')
     write_file(SUB_DIR_1_SUB_DIR, 'bad\'name', 'bad', 'Bad Filename2')
@@ -59,6 +71,9 @@ if __name__ == "__main__":
     write_file(SUB_DIR_2, 'temporary', '~', 'temporary2')
     write_file(SUB_DIR_2, 'executable', 'exe', 'exec file')
     write_file(SUB_DIR_2, 'single', 'txt', 'Howdy!')
+    os.mkdir(SUB_DIR_2_LOGS)
+    write_file(SUB_DIR_2_LOGS, 'events_copy', 'log',
+               '# exported again\n' + LOG_LINES)
 
     # SUB_DIR_3 = Y3
     write_file(SUB_DIR_3, 'same_content', 'txt', 'same content')
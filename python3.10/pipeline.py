@@ -0,0 +1,42 @@
+import asyncio
+import itertools
+from collections.abc import AsyncIterator, Awaitable, Iterator
+from concurrent.futures import Executor
+
+DONE = None
+BATCH_SIZE = 256
+
+
+async def drain(queue: asyncio.Queue) -> AsyncIterator:
+    """
+    Yields items put to <queue> by the previous stage until DONE
+    """
+    while (item := await queue.get()) is not DONE:
+        yield item
+
+
+async def read_batches(iterator: Iterator, executor: Executor,
+                       size: int = BATCH_SIZE) -> AsyncIterator[list]:
+    """
+    Yields lists of up to <size> items of blocking <iterator>,
+    advancing it on <executor> so the event loop isn't blocked
+    """
+    loop = asyncio.get_running_loop()
+    while batch := await loop.run_in_executor(
+            executor, list, itertools.islice(iterator, size)):
+        yield batch
+
+
+async def run_stages(*stages: Awaitable):
+    """
+    Runs pipeline stages concurrently until all of them finish.
+    If any stage fails, the others are cancelled, so none of them
+    is left waiting on a queue that won't be filled or emptied.
+    """
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,234 @@
+import os
+import json
+
+from file_info import FileInfo
+from index import DestinationIndex
+
+OPERATIONS = ('mkdir', 'copy', 'copy_as', 'delta', 'hardlink', 'reflink',
+              'chmod', 'delete', 'skip')
+COPIES = ('copy', 'copy_as', 'delta', 'hardlink', 'reflink')
+
+
+class Operation:
+    """
+    Single planned change of the destination folder.
+    Hardlinks and reflinks are made from <origin> destination file
+    with the same content as <path>, delta copy reuses blocks
+    of <origin> and replaces it.
+    """
+    __slots__ = ('kind', 'path', 'target', 'size', 'mode', 'origin')
+
+    def __init__(self, kind: str, path: str, target: str = '',
+                 size: int = 0, mode: int = 0, origin: str = ''):
+        if kind not in OPERATIONS:
+            raise ValueError(f"{kind} is not a valid operation.")
+        self.kind = kind
+        self.path = path
+        self.target = target
+        self.size = size
+        self.mode = mode
+        self.origin = origin
+
+    def to_json(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__
+                if getattr(self, name)}
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'Operation':
+        return cls(**data)
+
+
+class Plan:
+    """
+    Ordered list of operations decided while checking source files.
+    Planned copies and deletions are applied to the destination index
+    right away, so later checks see the destination as it will be.
+    """
+    def __init__(self, destination: str, index: DestinationIndex):
+        self.operations: list[Operation] = []
+        self._destination = destination
+        self._index = index
+        self._directories: set[str] = set()
+        self._copies: dict[str, list[Operation]] = {}
+        self._modes: dict[str, int] = {}
+        self._names: dict[str, str] = {}
+        self._links: dict[str, tuple[str, str]] = {}
+        self._bases: dict[str, str] = {}
+        self._planned: set[str] = set()
+
+    def _make_directories(self, path: str):
+        """
+        Plans creation of missing directories, each checked only once
+        """
+        missing = []
+        while path not in self._directories and not os.path.isdir(path):
+            missing.append(path)
+            self._directories.add(path)
+            path = os.path.dirname(path)
+        self._directories.add(path)
+        for directory in reversed(missing):
+            self.operations.append(Operation('mkdir', directory))
+
+    def target_path(self, path: str, name: str = '') -> str:
+        """
+        Returns path relative to destination folder for source <path>
+        """
+        return os.path.join(self._destination,
+                            *path.split(os.sep)[:-1],
+                            name or os.path.basename(path))
+
+    def copy(self, file: FileInfo, name: str = '') -> str:
+        """
+        Plans copy of <file> to destination folder,
+        optionally under a different <name>
+        """
+        name = name or self._names.pop(file.path, '')
+        target = self.target_path(file.path, name)
+        basis = self._bases.pop(file.path, '')
+        # Only an older version at the same path is worth a delta copy,
+        # a basis elsewhere is removed once the file is copied
+        kind, origin = self._links.pop(
+            file.path, ('delta', basis) if basis == target
+            else ('copy_as' if name else 'copy', ''))
+        self._supersede(target)
+        self._make_directories(os.path.dirname(target))
+        operations = [Operation(kind, file.path, target, size=file.size,
+                                origin=origin)]
+        mode = self._modes.pop(file.path, None)
+        # Hardlink shares mode of its origin, it can't be changed alone
+        if mode is not None and kind != 'hardlink':
+            operations.append(Operation('chmod', target, mode=mode))
+        self.operations.extend(operations)
+        self._copies[target] = operations
+        self._planned.add(target)
+        if basis and kind != 'delta' and basis != target:
+            self.operations.append(Operation('delete', basis))
+        self._index.add(target, origin=file)
+        return target
+
+    def chmod(self, file: FileInfo, mode: int):
+        """
+        Plans permission change of <file> once it is copied
+        """
+        self._modes[file.path] = mode
+
+    def rename(self, file: FileInfo, name: str):
+        """
+        Plans copy of <file> under a different <name>
+        """
+        self._names[file.path] = name
+
+    def link(self, file: FileInfo, origin: str, kind: str):
+        """
+        Plans copy of <file> as a hardlink or reflink (<kind>)
+        of destination file <origin> with the same content
+        """
+        self._links[file.path] = (kind, origin)
+        self._planned.add(origin)
+
+    def delta(self, file: FileInfo, basis: str):
+        """
+        Plans copy of <file> reusing unchanged blocks
+        of destination file <basis>, which it replaces.
+        Blocks are reused only if <basis> is at the same path
+        """
+        if not self._supersede(basis):
+            self._bases[file.path] = basis
+        self._index.remove(basis)
+
+    def is_planned(self, path: str) -> bool:
+        """
+        Returns True if destination file <path> is copied
+        or linked to in this run
+        """
+        return path in self._planned
+
+    def delete(self, path: str):
+        """
+        Plans removal of destination file
+        """
+        if not self._supersede(path):
+            self.operations.append(Operation('delete', path))
+        self._index.remove(path)
+
+    def skip(self, file: FileInfo):
+        """
+        Records that <file> won't be copied
+        """
+        self._modes.pop(file.path, None)
+        self._names.pop(file.path, None)
+        self._links.pop(file.path, None)
+        basis = self._bases.pop(file.path, '')
+        if basis:
+            self.operations.append(Operation('delete', basis))
+        self.operations.append(Operation('skip', file.path))
+
+    def replay(self, operation: Operation, origin: FileInfo or None = None):
+        """
+        Plans again <operation> journaled by an interrupted run,
+        source file of copies is stat'ed unless its <origin> is given
+        """
+        if operation.kind in COPIES:
+            origin = origin or FileInfo.from_path(operation.path)
+            self._index.add(operation.target, origin=origin)
+        if operation.kind == 'delta':
+            self._index.remove(operation.origin)
+        elif operation.kind == 'delete':
+            self._index.remove(operation.path)
+        elif operation.kind == 'mkdir':
+            self._directories.add(operation.path)
+        self.operations.append(operation)
+
+    def commit(self, operations: list[Operation]):
+        """
+        Marks <operations> as applied,
+        they won't be superseded by later changes
+        """
+        for operation in operations:
+            self._copies.pop(operation.target, None)
+
+    def _supersede(self, target: str) -> bool:
+        """
+        Cancels copy to <target> planned earlier in this run
+        """
+        operations = self._copies.pop(target, None)
+        for operation in operations or ():
+            operation.kind, operation.target = 'skip', ''
+        return operations is not None
+
+    def totals(self) -> dict[str, int]:
+        """
+        Returns number of operations of every kind and bytes to copy
+        """
+        totals = dict.fromkeys(OPERATIONS, 0)
+        totals['bytes'] = 0
+        for operation in self.operations:
+            totals[operation.kind] += 1
+            if operation.kind in ('copy', 'copy_as'):
+                totals['bytes'] += operation.size
+        return totals
+
+    def save(self, filename: str):
+        """
+        Saves the plan as JSON
+        """
+        with open(filename, 'w') as file:
+            json.dump({'destination': self._destination,
+                       'totals': self.totals(),
+                       'operations': [operation.to_json()
+                                      for operation in self.operations]},
+                      file, indent=2)
+
+    @staticmethod
+    def load_operations(filename: str, destination: str) -> list[Operation]:
+        """
+        Reads operations of the plan saved as JSON,
+        it must have been made for the same <destination>
+        """
+        with open(filename) as file:
+            plan = json.load(file)
+        if os.path.normpath(plan['destination']) != \
+                os.path.normpath(destination):
+            raise ValueError(f"{filename}: plan is for destination"
+                             + f" {plan['destination']}.")
+        return [Operation.from_json(data) for data in plan['operations']]
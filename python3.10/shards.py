@@ -0,0 +1,184 @@
+import os
+import sqlite3
+from multiprocessing.synchronize import Barrier
+
+from catalog import LOCK_TIMEOUT
+from duplicates import choose_survivor, find_same_names
+from file_info import FileInfo
+from hasher import Hasher, partial_is_full
+
+UNITS_PER_SHARD = 4
+CLAIMS_SUFFIX = '.shards'
+
+
+def _entries(path: str) -> int:
+    try:
+        return len(os.listdir(path))
+    except OSError:
+        return 0
+
+
+def _subdirectories(path: str) -> list[str]:
+    try:
+        with os.scandir(path) as entries:
+            return sorted(entry.path for entry in entries
+                          if entry.is_dir(follow_symlinks=False))
+    except OSError:
+        return []
+
+
+def partition(sources: list[str],
+              shards: int) -> tuple[list[list[str]], frozenset[str]]:
+    """
+    Splits sources into units walked as a whole: source roots and,
+    while there are fewer than UNITS_PER_SHARD units per shard,
+    subdirectories of the unit with the most entries. Units are
+    assigned to shards largest first, each to the least loaded one.
+    Returns non-empty lists of units by shard and split subdirectories,
+    which are excluded from walks of their parents.
+    """
+    weights = {root: _entries(root) for root in sources}
+    split: set[str] = set()
+    while len(weights) < shards * UNITS_PER_SHARD:
+        candidates = [unit for unit in weights if unit not in split]
+        if not candidates:
+            break
+        unit = max(candidates, key=weights.get)
+        split.add(unit)
+        for subdirectory in _subdirectories(unit):
+            weights[subdirectory] = _entries(subdirectory)
+            weights[unit] -= 1
+    partitions: list[list[str]] = [[] for _ in range(shards)]
+    loads = [0] * shards
+    for unit in sorted(weights, key=weights.get, reverse=True):
+        number = loads.index(min(loads))
+        partitions[number].append(unit)
+        loads[number] += weights[unit] + 1
+    excluded = frozenset(unit for unit in weights if unit not in sources)
+    return [units for units in partitions if units], excluded
+
+
+class Claim:
+    """
+    Source file planned by one of the shards
+    """
+    __slots__ = ('shard', 'path', 'name', 'size', 'ctime', 'digest')
+
+    def __init__(self, shard: int, path: str, name: str, size: int,
+                 ctime: int, digest: bytes or None):
+        self.shard = shard
+        self.path = path
+        self.name = name
+        self.size = size
+        self.ctime = ctime
+        self.digest = digest
+
+
+class Shard:
+    """
+    Partition of sources run by a worker process. Once metadata checks
+    are done, shards exchange claims on their source files that passed
+    them through a shared SQLite database and drop files conflicting
+    with any other claimed file. Conflicts are resolved with default
+    actions, the same way on every shard and without shards:
+        content - of non-empty files with the same content
+                  duplicate_survivor is kept
+        name    - of the other files with the same name the newest is kept
+    Ties are broken by path, so the result doesn't depend on timing.
+    Files of one shard don't conflict with other shards afterwards,
+    so shards check and copy them independently.
+    Destination files <scanned> by the parent process are indexed
+    by every shard instead of walking the destination again.
+    """
+    def __init__(self, number: int, path: str, barrier: Barrier,
+                 exclude: frozenset[str] = frozenset(),
+                 scanned: list[FileInfo] or None = None):
+        self.number = number
+        self.exclude = exclude
+        self.scanned = scanned
+        self._path = path
+        self._barrier = barrier
+
+    @staticmethod
+    def create(path: str):
+        """
+        Creates empty claims database at <path>
+        """
+        Shard.remove(path)
+        connection = sqlite3.connect(path)
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute(
+            'CREATE TABLE claims (shard INTEGER, path TEXT PRIMARY KEY,'
+            ' name TEXT, size INTEGER, ctime INTEGER, digest BLOB)')
+        connection.commit()
+        connection.close()
+
+    @staticmethod
+    def remove(path: str):
+        """
+        Removes claims database at <path> with its WAL files
+        """
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def resolve(self, files: list[FileInfo], hasher: Hasher,
+                survivor: str) -> set[str]:
+        """
+        Claims <files>, waits for other shards, digests non-empty files
+        of sizes claimed more than once and returns paths of files which lose
+        conflicts with any claimed files
+        """
+        connection = sqlite3.connect(self._path, timeout=LOCK_TIMEOUT)
+        try:
+            with connection:
+                connection.executemany(
+                    'INSERT INTO claims VALUES (?, ?, ?, ?, ?, NULL)',
+                    [(self.number, file.path, file.name, file.size,
+                      file.ctime) for file in files])
+            self._barrier.wait()
+            sizes = {size for size, in connection.execute(
+                'SELECT size FROM claims WHERE size > 0 GROUP BY size'
+                ' HAVING COUNT(*) > 1')}
+            small = [file for file in files if file.size in sizes
+                     and partial_is_full(file.size)]
+            large = [file for file in files if file.size in sizes
+                     and not partial_is_full(file.size)]
+            digests = hasher.partial_many([(file.path, file.size)
+                                           for file in small]) + \
+                hasher.full_many([(file.path, file.size) for file in large])
+            with connection:
+                connection.executemany(
+                    'UPDATE claims SET digest = ? WHERE path = ?',
+                    zip(digests, [file.path for file in small + large]))
+            self._barrier.wait()
+            claims = [Claim(*row) for row in connection.execute(
+                'SELECT * FROM claims ORDER BY path')]
+        finally:
+            connection.close()
+        return {claim.path for claim in self._losers(claims, survivor)
+                if claim.shard == self.number}
+
+    @staticmethod
+    def _losers(claims: list[Claim], survivor: str) -> list[Claim]:
+        """
+        Returns claims losing conflicts with any other claims
+        """
+        losers: list[Claim] = []
+        by_content: dict[tuple[int, bytes], list[Claim]] = {}
+        for claim in claims:
+            if claim.digest is not None:
+                by_content.setdefault((claim.size, claim.digest),
+                                      []).append(claim)
+        for group in by_content.values():
+            if len(group) > 1:
+                kept = choose_survivor(group, survivor)
+                losers.extend(claim for claim in group if claim is not kept)
+        lost = {claim.path for claim in losers}
+        for group in find_same_names([claim for claim in claims
+                                      if claim.path not in lost]):
+            kept = choose_survivor(group, 'newest')
+            losers.extend(claim for claim in group if claim is not kept)
+        return losers
@@ -0,0 +1,124 @@
+import zlib
+from array import array
+
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+SIGNATURE_BINS = 64
+BAND_BINS = 4
+EMPTY = 0xffffffff
+MIX = 0x9e3779b1
+SHIFT = (SIGNATURE_BINS - 1).bit_length()
+
+
+def _update(minimums: list[int], lines: list[bytes]):
+    for value in set(map(zlib.crc32, lines)):
+        # Spread the CRC, consecutive lines differ in few bits only
+        value = value * MIX & EMPTY
+        position = value & (SIGNATURE_BINS - 1)
+        value >>= SHIFT
+        if value < minimums[position]:
+            minimums[position] = value
+
+
+class Fingerprint:
+    """
+    MinHash signature of the set of lines of data fed block by block,
+    like hashlib objects. One hash function is used: lines are hashed
+    into SIGNATURE_BINS bins, keeping the minimum of every bin
+    (one permutation hashing).
+    """
+    def __init__(self):
+        self._minimums = [EMPTY] * SIGNATURE_BINS
+        self._rest = b''
+
+    def update(self, block: bytes):
+        lines = (self._rest + block).split(b'\n')
+        self._rest = lines.pop()
+        _update(self._minimums, lines)
+
+    def digest(self) -> bytes:
+        if self._rest:
+            _update(self._minimums, [self._rest])
+            self._rest = b''
+        return array('I', self._minimums).tobytes()
+
+
+def fingerprint(path: str) -> bytes:
+    """
+    Returns signature of the file, read in a single streaming pass
+    """
+    signature = Fingerprint()
+    with open(path, 'rb') as file:
+        while block := file.read(READ_BLOCK_SIZE):
+            signature.update(block)
+    return signature.digest()
+
+
+def similarity(signature: bytes, other: bytes) -> float:
+    """
+    Estimates Jaccard similarity of line sets of two files
+    from their signatures
+    """
+    used = same = 0
+    for value, other_value in zip(array('I', signature), array('I', other)):
+        if value != EMPTY or other_value != EMPTY:
+            used += 1
+            same += value == other_value
+    return same / used if used else 1.0
+
+
+def _bands(signature: bytes) -> list[bytes]:
+    """
+    Splits signature into bands of BAND_BINS bins, bands of empty bins
+    are left out, they would put all small files in one bucket
+    """
+    width = BAND_BINS * array('I').itemsize
+    empty = array('I', [EMPTY] * BAND_BINS).tobytes()
+    return [bytes([number]) + band
+            for number, band in enumerate(
+                signature[offset:offset + width]
+                for offset in range(0, len(signature), width))
+            if band != empty]
+
+
+class LSHIndex:
+    """
+    Locality-sensitive hashing index of file signatures.
+    Signatures are split into bands and files sharing any whole band
+    land in the same bucket, so only files likely to be similar
+    are compared and lookups don't grow with the number of files.
+    """
+    def __init__(self):
+        self._signatures: dict[str, bytes] = {}
+        self._buckets: dict[bytes, dict[str, None]] = {}
+
+    def add(self, path: str, signature: bytes):
+        self.remove(path)
+        self._signatures[path] = signature
+        for band in _bands(signature):
+            self._buckets.setdefault(band, {})[path] = None
+
+    def remove(self, path: str):
+        signature = self._signatures.pop(path, None)
+        if signature is None:
+            return
+        for band in _bands(signature):
+            bucket = self._buckets[band]
+            del bucket[path]
+            if not bucket:
+                del self._buckets[band]
+
+    def find(self, signature: bytes,
+             threshold: float) -> list[tuple[str, float]]:
+        """
+        Returns paths of indexed files at least <threshold> similar
+        with their similarity, the most similar first
+        """
+        candidates: dict[str, None] = {}
+        for band in _bands(signature):
+            candidates.update(self._buckets.get(band, {}))
+        found = [(path, similarity(signature, self._signatures[path]))
+                 for path in candidates]
+        found = [(path, value) for path, value in found
+                 if value >= threshold]
+        found.sort(key=lambda item: item[1], reverse=True)
+        return found
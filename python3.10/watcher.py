@@ -0,0 +1,198 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+from collections.abc import Iterator
+
+from walker import Walker
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+POLL_INTERVAL = 1.0
+DEBOUNCE_DELAY = 0.5
+
+
+def _list_directories(root: str) -> Iterator[str]:
+    """
+    Yields <root> and all directories under it
+    """
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        yield path
+        try:
+            with os.scandir(path) as entries:
+                stack.extend(entry.path for entry in entries
+                             if entry.is_dir(follow_symlinks=False))
+        except OSError:
+            continue
+
+
+class InotifyWatcher:
+    """
+    Reports files created or modified under the roots using inotify,
+    directories created later are watched as well
+    """
+    def __init__(self, roots: list[str]):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify is not available")
+        self._roots = roots
+        self._watches: dict[int, str] = {}
+        for root in roots:
+            self._watch_tree(root)
+
+    def _watch_tree(self, root: str) -> list[str]:
+        """
+        Watches every directory under <root>, returns files found there
+        """
+        files = []
+        for path in _list_directories(root):
+            wd = self._add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(error, "inotify watch limit reached")
+                continue
+            self._watches[wd] = path
+            with os.scandir(path) as entries:
+                files.extend(entry.path for entry in entries
+                             if entry.is_file(follow_symlinks=False))
+        return files
+
+    def changes(self, timeout: float or None) -> list[str]:
+        """
+        Waits up to <timeout> seconds for events,
+        returns paths of created or modified files
+        """
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return []
+        try:
+            buffer = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+        changed = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = EVENT.unpack_from(buffer, offset)
+            offset += EVENT.size
+            name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, report every file again
+                return [path for root in self._roots
+                        for path in self._watch_tree(root)]
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if wd not in self._watches:
+                continue
+            path = os.path.join(self._watches[wd], name)
+            if not mask & IN_ISDIR:
+                changed.append(path)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                changed.extend(self._watch_tree(path))
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """
+    Reports files created or modified under the roots by comparing
+    size and mtime of all files every <interval> seconds
+    """
+    def __init__(self, roots: list[str], walker: Walker,
+                 interval: float = POLL_INTERVAL):
+        self._roots = roots
+        self._walker = walker
+        self._interval = interval
+        self._index = self._snapshot()
+        self._next_poll = time.monotonic() + interval
+
+    def _snapshot(self) -> dict[str, tuple[int, int]]:
+        return {file.path: (file.size, file.mtime)
+                for root in self._roots
+                for file in self._walker.walk(root)}
+
+    def changes(self, timeout: float or None) -> list[str]:
+        """
+        Waits up to <timeout> seconds for the next poll,
+        returns paths of created or modified files
+        """
+        delay = self._next_poll - time.monotonic()
+        if timeout is not None and timeout < delay:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(delay, 0))
+        self._next_poll = time.monotonic() + self._interval
+        index, self._index = self._index, self._snapshot()
+        return [path for path, state in self._index.items()
+                if index.get(path) != state]
+
+    def close(self):
+        pass
+
+
+def create_watcher(roots: list[str],
+                   walker: Walker) -> InotifyWatcher or PollingWatcher:
+    """
+    Returns inotify watcher of the roots, polling one if it's unavailable
+    """
+    try:
+        return InotifyWatcher(roots)
+    except (OSError, AttributeError, TypeError) as error:
+        print(f"==| Polling sources every {POLL_INTERVAL}s: {error} |==")
+        return PollingWatcher(roots, walker)
+
+
+class ChangeQueue:
+    """
+    Coalesces reported changes by path. A path is ready once no change
+    was reported for <delay> seconds, so files still being written
+    are processed only once, after they are complete.
+    """
+    def __init__(self, delay: float = DEBOUNCE_DELAY):
+        self._delay = delay
+        self._changes: dict[str, float] = {}
+
+    def push(self, path: str):
+        self._changes.pop(path, None)
+        self._changes[path] = time.monotonic()
+
+    def timeout(self) -> float or None:
+        """
+        Returns seconds until the oldest change is ready,
+        None if there are no changes
+        """
+        if not self._changes:
+            return None
+        oldest = next(iter(self._changes.values()))
+        return max(oldest + self._delay - time.monotonic(), 0)
+
+    def pop_ready(self) -> list[str]:
+        """
+        Removes and returns paths that are ready, oldest first
+        """
+        ready = []
+        deadline = time.monotonic() - self._delay
+        for path, changed in self._changes.items():
+            if changed > deadline:
+                break
+            ready.append(path)
+        for path in ready:
+            del self._changes[path]
+        return ready
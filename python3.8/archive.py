@@ -0,0 +1,152 @@
+import os
+import stat
+import time
+import shutil
+import tarfile
+import zipfile
+
+from file_info import FileInfo
+
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz',
+                '.txz')
+ZIP_SUFFIXES = ('.zip',)
+ARCHIVE_SUFFIXES = TAR_SUFFIXES + ZIP_SUFFIXES
+DEFAULT_MODE = 0o644
+NANOSECONDS = 10 ** 9
+BUFFER_SIZE = 1024 * 1024
+
+
+def is_archive(path):
+    """
+    Returns True if <path> is a tar or zip archive, by its suffix
+    """
+    return path.lower().endswith(ARCHIVE_SUFFIXES) and os.path.isfile(path)
+
+
+def member_of(path, archives):
+    """
+    Returns the one of <archives> <path> is a member of,
+    empty string if there is none
+    """
+    for archive in archives:
+        if path.startswith(archive + os.sep):
+            return archive
+    return ''
+
+
+def _member_path(archive, name):
+    """
+    Returns path of member <name> under <archive>, leading slashes
+    are dropped, empty string is returned for names with '..'
+    """
+    parts = [part for part in name.split('/') if part not in ('', '.')]
+    if not parts or '..' in parts:
+        return ''
+    return os.path.join(archive, *parts)
+
+
+class ArchiveMember(FileInfo):
+    """
+    Metadata of a file inside an archive. Its path is the archive path
+    joined with the member name, so members are copied to a directory
+    named after the archive. Members have no inode, their change time
+    is their modification time.
+    """
+    __slots__ = ()
+
+    def __init__(self, path, size, mode, mtime):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = size
+        self.mode = mode
+        self.ctime = self.mtime = mtime
+        self.dev = self.inode = 0
+
+
+def _tar_entries(path):
+    # Opened as a stream, compressed archives can't be read backwards
+    with tarfile.open(path, 'r|*') as archive:
+        for info in archive:
+            if info.isdir() or info.issym() or info.islnk():
+                continue
+            content = archive.extractfile(info) if info.isreg() else None
+            yield info.name, info.size, stat.S_IFREG | info.mode, \
+                int(info.mtime * NANOSECONDS), content
+
+
+def _zip_entries(path):
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            # Unix mode is kept in the high bits, zero if made elsewhere
+            mode = info.external_attr >> 16
+            if info.is_dir() or stat.S_ISLNK(mode):
+                continue
+            mtime = int(time.mktime(info.date_time + (0, 0, -1)))
+            if stat.S_IFMT(mode) not in (0, stat.S_IFREG):
+                yield info.filename, info.file_size, mode, \
+                    mtime * NANOSECONDS, None
+                continue
+            with archive.open(info) as content:
+                yield info.filename, info.file_size, \
+                    stat.S_IFREG | (stat.S_IMODE(mode) or DEFAULT_MODE), \
+                    mtime * NANOSECONDS, content
+
+
+def _entries(path):
+    """
+    Yields (name, size, mode, mtime, content) of archive members
+    other than directories and links, in archive order
+    """
+    if path.lower().endswith(ZIP_SUFFIXES):
+        return _zip_entries(path)
+    return _tar_entries(path)
+
+
+def read_members(path):
+    """
+    Reads archive at <path> once, in order, and yields its members with
+    streams of their content, valid until the next member is read.
+    Special members (devices, fifos) are yielded without content.
+    Directories and links are left out, links can't be followed
+    in a stream. Members with names leading out of the archive ('..')
+    and repeated members are skipped.
+    """
+    seen = set()
+    for name, size, mode, mtime, content in _entries(path):
+        member_path = _member_path(path, name)
+        if not member_path or member_path in seen:
+            print(f"==| Skipping archive member {name} of {path} |==")
+            continue
+        seen.add(member_path)
+        yield ArchiveMember(member_path, size, mode, mtime), content
+
+
+def _write(content, target, mode, mtime):
+    with open(target, 'wb') as file:
+        shutil.copyfileobj(content, file, BUFFER_SIZE)
+    os.chmod(target, stat.S_IMODE(mode))
+    os.utime(target, ns=(mtime, mtime))
+
+
+def extract(path, targets):
+    """
+    Reads archive at <path> once and streams members whose paths are keys
+    of <targets> straight to their target paths, with their mode and
+    mtime, so they are recognized as up to date on the next run.
+    Yields path of every member with the error writing it, if any.
+    Stops reading once all members are written.
+    """
+    targets = dict(targets)
+    for name, _, mode, mtime, content in _entries(path):
+        member_path = _member_path(path, name)
+        target = targets.pop(member_path, None)
+        if target is None or content is None:
+            continue
+        try:
+            _write(content, target, mode, mtime)
+        except OSError as error:
+            yield member_path, error
+        else:
+            yield member_path, None
+        if not targets:
+            break
@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+
+from config import Config
+from copier import COPY_MODES, DEDUPE_MODES
+from file_manager import FileManager, ShardedFileManager
+from metrics import metrics, syscall_counts
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+FILLER_SIZE = 1024 * 1024
+RATIOS = ('duplicate_content', 'duplicate_names', 'bad_names',
+          'bad_permissions', 'empty', 'temporary')
+
+
+class TreeGenerator:
+    """
+    Generates synthetic source and destination trees.
+    Contents differ in their first bytes and share a random filler,
+    so generating large trees is fast but digests still differ.
+    """
+    def __init__(self, args):
+        self._args = args
+        self._random = random.Random(args.seed)
+        self._filler = self._random.getrandbits(8 * FILLER_SIZE) \
+            .to_bytes(FILLER_SIZE, 'little')
+        self._contents = []
+        self._names = []
+        self.files = 0
+        self.bytes = 0
+
+    def _size(self):
+        # Log-uniform distribution, most files are small
+        low, high = self._args.min_size, self._args.max_size
+        return int(low * (high / low) ** self._random.random())
+
+    def _directory(self, root):
+        depth = self._random.randint(0, self._args.depth)
+        return os.path.join(root, *(f"d{self._random.randrange(4)}"
+                                    for _ in range(depth)))
+
+    def _happens(self, ratio):
+        return self._random.random() < getattr(self._args, ratio)
+
+    def _write(self, path, content_id, size):
+        header = f"{content_id}\n".encode()[:size]
+        with open(path, 'wb') as file:
+            file.write(header)
+            remaining = size - len(header)
+            while remaining > 0:
+                chunk = self._filler[:remaining]
+                file.write(chunk)
+                remaining -= len(chunk)
+        self.files += 1
+        self.bytes += size
+
+    def generate(self, root, count):
+        """
+        Writes <count> files spread over the directories under <root>
+        """
+        for number in range(count):
+            directory = self._directory(root)
+            os.makedirs(directory, exist_ok=True)
+            if self._happens('duplicate_content') and self._contents:
+                content_id, size = self._random.choice(self._contents)
+            elif self._happens('empty'):
+                content_id, size = len(self._contents), 0
+            else:
+                content_id, size = len(self._contents), self._size()
+                self._contents.append((content_id, size))
+            if self._happens('duplicate_names') and self._names:
+                name = self._random.choice(self._names)
+            else:
+                name = f"file{len(self._names)}.dat"
+                self._names.append(name)
+            if self._happens('bad_names'):
+                name = f"bad#{number}'{name}"
+            if self._happens('temporary'):
+                name += '.tmp'
+            path = os.path.join(directory, name)
+            if os.path.exists(path):
+                continue
+            self._write(path, content_id, size)
+            if self._happens('bad_permissions'):
+                os.chmod(path, 0o777)
+
+
+def peak_rss():
+    """
+    Returns peak resident set size in KiB of this process
+    and of its finished children (hashing processes)
+    """
+    if resource is None:
+        return None
+    scale = 1024 if sys.platform == 'darwin' else 1
+    return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            // scale,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN)
+            .ru_maxrss // scale}
+
+
+def run(args):
+    """
+    Generates trees, runs the file manager on them and returns results
+    """
+    workdir = tempfile.mkdtemp(prefix='file_manager_benchmark_')
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        generator = TreeGenerator(args)
+        sources = [f"S{number}" for number in range(args.sources)]
+        for source in sources:
+            os.mkdir(source)
+            generator.generate(source, args.files // args.sources)
+        source_files, source_bytes = generator.files, generator.bytes
+        os.mkdir('X')
+        generator.generate('X', args.destination_files)
+
+        config = Config('X', sources, True, jobs=args.jobs,
+                        hash_jobs=args.hash_jobs, scan_jobs=args.scan_jobs,
+                        shards=args.shards,
+                        copy_mode=args.copy_mode, dedupe=args.dedupe,
+                        near_duplicates=args.near_duplicates,
+                        filename=args.config)
+        syscalls = syscall_counts()
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(
+                sys.stderr if args.verbose else devnull):
+            manager = ShardedFileManager if args.shards > 1 \
+                else FileManager
+            file_manager = manager('X', sources, config)
+            file_manager.start()
+        elapsed = time.perf_counter() - start
+        after = syscall_counts()
+        totals = file_manager.totals()
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(workdir)
+
+    return {
+        'implementation': os.path.basename(os.path.dirname(
+            os.path.abspath(__file__))),
+        'python': platform.python_version(),
+        'parameters': {name: value for name, value in vars(args).items()
+                       if name not in ('output', 'verbose', 'keep')},
+        'results': {
+            'source_files': source_files,
+            'source_bytes': source_bytes,
+            'copied_files': totals['copy'] + totals['copy_as'],
+            'copied_bytes': totals['bytes'],
+            'linked_files': totals['hardlink'] + totals['reflink'],
+            'seconds': round(elapsed, 4),
+            'files_per_second': round(source_files / elapsed, 1),
+            'mb_per_second': round(totals['bytes'] / elapsed / 2 ** 20, 2),
+            'peak_rss_kib': peak_rss(),
+            'syscalls': after and {name: after[name] - syscalls[name]
+                                   for name in after},
+        },
+        'metrics': metrics.snapshot(),
+    }
+
+
+def get_arguments():
+    """
+    Provide and check command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        prog='benchmark',
+        description='Runs the file manager on generated trees')
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--sources', type=int, default=3)
+    parser.add_argument('--destination-files', type=int, default=0)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--min-size', type=int, default=1024)
+    parser.add_argument('--max-size', type=int, default=1024 * 1024)
+    for ratio in RATIOS:
+        parser.add_argument(f"--{ratio.replace('_', '-')}", type=float,
+                            default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--hash-jobs', type=int, default=1)
+    parser.add_argument('--scan-jobs', type=int, default=1)
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--copy-mode', choices=COPY_MODES, default='auto')
+    parser.add_argument('--dedupe', choices=DEDUPE_MODES, default='')
+    parser.add_argument('--near-duplicates', type=float, default=0)
+    parser.add_argument('--config', default=os.path.join(
+        os.path.dirname(__file__), 'config.json'))
+    parser.add_argument('-o', '--output', default='')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--keep', action='store_true')
+
+    args = parser.parse_args()
+
+    if args.sources < 1 or args.jobs < 1 or args.hash_jobs < 1 \
+            or args.scan_jobs < 1 or args.shards < 1 \
+            or not 0 < args.min_size <= args.max_size:
+        print("==| Invalid benchmark parameters. |==")
+        sys.exit(-1)
+    args.config = os.path.abspath(args.config)
+
+    return args
+
+
+if __name__ == "__main__":
+    args = get_arguments()
+    results = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(results + '\n')
+    else:
+        print(results)
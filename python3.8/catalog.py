@@ -0,0 +1,124 @@
+import os
+import sqlite3
+import pathlib
+import contextlib
+
+CATALOG_VERSION = 2
+COMMIT_INTERVAL = 1000
+LOCK_TIMEOUT = 60
+
+
+class Catalog:
+    """
+    Persistent catalog of destination files reused across runs.
+    Keeps relative path, size, mtime, inode, content digests
+    and similarity signature.
+    Digests are dropped when the hash algorithm changes.
+    The catalog may be shared by shard processes: it is in WAL mode,
+    so readers don't block the writer, and changes are written
+    in short batched transactions.
+    In <dry_run> a copy of the catalog is used in memory,
+    so the destination folder isn't changed.
+    """
+    def __init__(self, destination, filename, algorithm, dry_run=False):
+        self.path = os.path.join(destination, filename)
+        self._destination = destination
+        self._writes = []
+        self._connection = self._connect(dry_run)
+        self._connection.execute('PRAGMA journal_mode = WAL')
+        version = self._connection.execute('PRAGMA user_version').fetchone()
+        if version[0] != CATALOG_VERSION:
+            self._connection.execute('DROP TABLE IF EXISTS files')
+            self._connection.execute(
+                f'PRAGMA user_version = {CATALOG_VERSION}')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, '
+            'inode INTEGER, partial BLOB, full BLOB, fingerprint BLOB)')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS settings ('
+            'name TEXT PRIMARY KEY, value TEXT)')
+        stored = self._connection.execute(
+            "SELECT value FROM settings WHERE name = 'algorithm'").fetchone()
+        if stored is None or stored[0] != algorithm:
+            self._connection.execute(
+                'UPDATE files SET partial = NULL, full = NULL,'
+                ' fingerprint = NULL')
+            self._connection.execute(
+                "INSERT OR REPLACE INTO settings VALUES ('algorithm', ?)",
+                (algorithm,))
+        self._connection.commit()
+
+    def _connect(self, dry_run):
+        if not dry_run:
+            return sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+        connection = sqlite3.connect(':memory:')
+        if os.path.exists(self.path):
+            # Immutable, as read only access would still create WAL files
+            uri = pathlib.Path(os.path.abspath(self.path)).as_uri()
+            with contextlib.closing(sqlite3.connect(
+                    f"{uri}?immutable=1", uri=True)) as stored:
+                stored.backup(connection)
+        return connection
+
+    def _key(self, path):
+        return os.path.relpath(path, self._destination)
+
+    def _execute(self, query, parameters):
+        self._writes.append((query, parameters))
+        if len(self._writes) >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        """
+        Writes pending changes in one transaction
+        """
+        with self._connection:
+            for query, parameters in self._writes:
+                self._connection.execute(query, parameters)
+        self._writes.clear()
+
+    def load(self):
+        """
+        Returns (size, mtime, inode, partial, full, fingerprint)
+        of every cataloged file
+        keyed by its path in destination folder
+        """
+        return {os.path.join(self._destination, row[0]): row[1:]
+                for row in self._connection.execute('SELECT * FROM files')}
+
+    def store(self, file):
+        """
+        Saves metadata of new or changed file, forgetting its digests
+        """
+        self._execute(
+            'INSERT OR REPLACE INTO files'
+            ' VALUES (?, ?, ?, ?, NULL, NULL, NULL)',
+            (self._key(file.path), file.size, file.mtime, file.inode))
+
+    def store_digest(self, path, partial=b'', full=b'', fingerprint=b''):
+        """
+        Saves computed digests or similarity signature of cataloged file
+        """
+        if partial:
+            self._execute('UPDATE files SET partial = ? WHERE path = ?',
+                          (partial, self._key(path)))
+        if full:
+            self._execute('UPDATE files SET full = ? WHERE path = ?',
+                          (full, self._key(path)))
+        if fingerprint:
+            self._execute('UPDATE files SET fingerprint = ? WHERE path = ?',
+                          (fingerprint, self._key(path)))
+
+    def forget(self, path):
+        """
+        Removes file from catalog
+        """
+        self._execute('DELETE FROM files WHERE path = ?', (self._key(path),))
+
+    def close(self):
+        """
+        Commits pending changes and closes the catalog
+        """
+        self.commit()
+        self._connection.close()
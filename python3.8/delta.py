@@ -0,0 +1,104 @@
+import math
+import zlib
+import hashlib
+
+MIN_BLOCK_SIZE = 4 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+DELTA_MIN_SIZE = 1024 * 1024
+ROLL_BLOCKS = 4
+PROBE_BLOCKS = 16
+DELTA_MAX_LITERAL = 0.25
+ADLER_MODULUS = 65521
+LITERAL = -1
+
+
+def block_size(size):
+    """
+    Returns block size for file of <size> bytes, about its square root
+    rounded to whole pages, so bigger files have fewer blocks to match
+    """
+    size = math.isqrt(size) // MIN_BLOCK_SIZE * MIN_BLOCK_SIZE
+    return min(max(size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def _strong(block):
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+def signature(basis, block):
+    """
+    Returns offsets of full blocks of <basis> by their weak (Adler-32)
+    and strong checksum
+    """
+    blocks = {}
+    offset = 0
+    while len(data := basis.read(block)) == block:
+        blocks.setdefault(zlib.adler32(data), {}).setdefault(
+            _strong(data), offset)
+        offset += block
+    return blocks
+
+
+def _roll(weak, out, into, block):
+    """
+    Moves Adler-32 checksum of a window one byte forward
+    """
+    a = ((weak & 0xffff) - out + into) % ADLER_MODULUS
+    b = ((weak >> 16) - block * out + a - 1) % ADLER_MODULUS
+    return (b << 16) | a
+
+
+def match(source, size, block, blocks, basis_size, max_literal):
+    """
+    Yields runs of <source> (bytes-like, e.g. mmap) as (offset, length,
+    basis offset), basis offset is LITERAL for data not found in basis.
+    Window is rolled byte by byte through changed regions, so matches
+    are found again after insertions of any length, and matched blocks
+    are skipped whole. Only past <basis_size> of the basis, regions
+    longer than ROLL_BLOCKS blocks are considered appended data
+    and only whole blocks are tried there.
+    Matching stops, the rest being literal, once more than <max_literal>
+    bytes aren't found or nothing is found in the first PROBE_BLOCKS.
+    """
+    position = literal = unmatched = 0
+    run_offset, run_length, run_basis = 0, 0, LITERAL
+    weak = None
+    while position + block <= size:
+        if unmatched + position - literal > max_literal or \
+                not literal and position >= PROBE_BLOCKS * block:
+            break
+        if weak is None:
+            weak = zlib.adler32(source[position:position + block])
+        candidates = blocks.get(weak)
+        if candidates:
+            basis = candidates.get(_strong(source[position:position + block]))
+            if basis is not None:
+                if literal < position:
+                    if run_length:
+                        yield run_offset, run_length, run_basis
+                    yield literal, position - literal, LITERAL
+                    unmatched += position - literal
+                    run_length = 0
+                if run_length and run_basis + run_length == basis:
+                    run_length += block
+                else:
+                    if run_length:
+                        yield run_offset, run_length, run_basis
+                    run_offset, run_length, run_basis = position, block, basis
+                position += block
+                literal = position
+                weak = None
+                continue
+        if position >= basis_size and \
+                position - literal >= ROLL_BLOCKS * block:
+            position += block
+            weak = None
+            continue
+        if position + block < size:
+            weak = _roll(weak, source[position], source[position + block],
+                         block)
+        position += 1
+    if run_length:
+        yield run_offset, run_length, run_basis
+    if literal < size:
+        yield literal, size - literal, LITERAL
@@ -0,0 +1,33 @@
+import os
+
+
+class FileInfo:
+    """
+    Metadata of a single file, filled from one stat call
+    """
+    __slots__ = ('path', 'name', 'size', 'mode', 'ctime', 'mtime',
+                 'dev', 'inode')
+
+    def __init__(self, path, name, st):
+        self.path = path
+        self.name = name
+        self.size = st.st_size
+        self.mode = st.st_mode
+        self.ctime = st.st_ctime_ns
+        self.mtime = st.st_mtime_ns
+        self.dev = st.st_dev
+        self.inode = st.st_ino
+
+    @classmethod
+    def from_entry(cls, entry):
+        """
+        Creates record from scandir entry, reusing its cached stat
+        """
+        return cls(entry.path, entry.name, entry.stat())
+
+    @classmethod
+    def from_path(cls, path):
+        """
+        Creates record for file under <path>
+        """
+        return cls(path, os.path.basename(path), os.stat(path))
@@ -0,0 +1,288 @@
+import os
+import copy
+import time
+
+from file_info import FileInfo
+from hasher import partial_is_full
+from metrics import metrics
+from similarity import LSHIndex
+from walker import Walker
+
+
+class DestinationIndex:
+    """
+    Index of files present in the destination folder, built once per run.
+    Files are grouped by size, then by partial hash (first and last block),
+    the full digest is computed only when both of these collide.
+    Files are also grouped by name for name conflict lookups.
+    Similarity signatures are computed and put in an LSH index
+    only once near duplicates are looked for.
+    Digests of unchanged files are taken from the persistent catalog.
+    Catalog and <ignored> paths of the script itself aren't indexed.
+    Files <scanned> by another index of the same destination are indexed
+    instead of walking it again, the catalog is up to date with them.
+    """
+    def __init__(self, destination, catalog, hasher,
+                 ignored=(),
+                 scanned=None):
+        self._destination = destination
+        self._catalog = catalog
+        self._hasher = hasher
+        self._ignored = (catalog.path, *ignored)
+        self._files = {}
+        self._by_size = {}
+        self._partial = {}
+        self._full = {}
+        self._names = {}
+        self._origins = {}
+        self._fingerprints = {}
+        self._similar = None
+        self._unindexed = {}
+        self._scan(scanned)
+
+    def _scan(self, scanned):
+        """
+        Walks destination folder once and fills the index
+        """
+        known = self._catalog.load()
+        if scanned is not None:
+            for file in scanned:
+                self._load(file, known.get(file.path))
+            return
+        with metrics.timer('scan_destination'):
+            for file in Walker(special_files='skip').walk(self._destination):
+                if not file.path.startswith(self._ignored):
+                    self._load(file, known.pop(file.path, None))
+        for path in known:
+            self._catalog.forget(path)
+
+    def _load(self, file, row):
+        """
+        Inserts scanned file, reusing cataloged digests if it didn't change
+        """
+        self._insert(file)
+        if row and row[:3] == (file.size, file.mtime, file.inode):
+            if row[3]:
+                self._partial[file.path] = row[3]
+            if row[4]:
+                self._full[file.path] = row[4]
+            if row[5]:
+                self._fingerprints[file.path] = row[5]
+        else:
+            self._catalog.store(file)
+
+    def _insert(self, file):
+        self._files[file.path] = file
+        self._by_size.setdefault(file.size, {})[file.path] = None
+        self._names.setdefault(file.name, {})[file.path] = None
+
+    def _hash_partial(self, paths):
+        """
+        Computes missing partial digests of indexed files in parallel
+        """
+        missing = [path for path in paths if path not in self._partial]
+        digests = self._hasher.partial_many(
+            [(self._origins.get(path, path), self._files[path].size)
+             for path in missing])
+        for path, digest in zip(missing, digests):
+            self._partial[path] = digest
+            self._catalog.store_digest(path, partial=digest)
+
+    def _fingerprint(self, paths):
+        """
+        Computes missing similarity signatures of indexed files in parallel
+        """
+        missing = [path for path in paths if path not in self._fingerprints]
+        signatures = self._hasher.fingerprint_many(
+            [(self._origins.get(path, path), self._files[path].size)
+             for path in missing])
+        for path, signature in zip(missing, signatures):
+            self._fingerprints[path] = signature
+            self._catalog.store_digest(path, fingerprint=signature)
+
+    def _hash_full(self, paths):
+        """
+        Computes missing full digests of indexed files in parallel
+        """
+        missing = [path for path in paths if path not in self._full]
+        digests = self._hasher.full_many(
+            [(self._origins.get(path, path), self._files[path].size)
+             for path in missing])
+        for path, digest in zip(missing, digests):
+            self._full[path] = digest
+            self._catalog.store_digest(path, full=digest)
+
+    def add(self, path, origin):
+        """
+        Registers file planned to be copied to the destination folder.
+        Until the copy is done content is read from its <origin> instead.
+        """
+        self.remove(path)
+        file = copy.copy(origin)
+        file.path, file.name = path, os.path.basename(path)
+        file.ctime = time.time_ns()
+        self._origins[path] = origin.path
+        self._insert(file)
+        if self._similar is not None:
+            self._unindexed[path] = None
+
+    def settle(self, path):
+        """
+        Refreshes metadata of file once its copy has finished
+        """
+        if self._origins.pop(path, None) is None:
+            return
+        file = FileInfo.from_path(path)
+        if file.size != self._files[path].size:
+            # Source changed while being copied, digests are stale
+            self.remove(path)
+            self._insert(file)
+            self._catalog.store(file)
+            if self._similar is not None:
+                self._unindexed[path] = None
+            return
+        self._files[path] = file
+        self._catalog.store(file)
+        self._catalog.store_digest(
+            path, partial=self._partial.get(path, b''),
+            full=self._full.get(path, b''),
+            fingerprint=self._fingerprints.get(path, b''))
+
+    def remove(self, path):
+        """
+        Unregisters file planned to be removed from the destination folder
+        """
+        file = self._files.pop(path, None)
+        if file is None:
+            return
+        bucket = self._by_size[file.size]
+        del bucket[path]
+        if not bucket:
+            del self._by_size[file.size]
+        same_name = self._names[file.name]
+        del same_name[path]
+        if not same_name:
+            del self._names[file.name]
+        self._partial.pop(path, None)
+        self._full.pop(path, None)
+        self._origins.pop(path, None)
+        self._fingerprints.pop(path, None)
+        self._unindexed.pop(path, None)
+        if self._similar is not None:
+            self._similar.remove(path)
+
+    def forget(self, path):
+        """
+        Drops file removed from the destination folder from the catalog
+        """
+        self._catalog.forget(path)
+
+    def get(self, path):
+        """
+        Returns metadata of indexed destination file
+        """
+        return self._files[path]
+
+    def files(self):
+        """
+        Returns metadata of all indexed destination files
+        """
+        return list(self._files.values())
+
+    def lookup(self, path):
+        """
+        Returns metadata of indexed destination file,
+        None if <path> isn't indexed
+        """
+        return self._files.get(path)
+
+    def is_current(self, path, file, checksum=False):
+        """
+        Returns True if indexed <path> is already up to date with <file>:
+        it is the same inode, or has the same size and mtime. With
+        <checksum> full digests are compared instead of mtime.
+        Files planned to be copied have the inode of their origin yet.
+        """
+        existing = self._files.get(path)
+        if existing is None or existing.size != file.size:
+            return False
+        if path not in self._origins and \
+                (existing.dev, existing.inode) == (file.dev, file.inode):
+            return True
+        if not checksum:
+            return existing.mtime == file.mtime
+        self._hash_full([path])
+        return self._full[path] == self._hasher.full(file.path, file.size,
+                                                     file.mtime)
+
+    def close(self):
+        """
+        Saves the index state to the persistent catalog
+        """
+        self._catalog.close()
+
+    def find_duplicate(self, file):
+        """
+        Returns path of the destination file with the same content
+        as <file> or empty string if there is none.
+        """
+        size = file.size
+        candidates = self._by_size.get(size)
+        if not candidates:
+            return ''
+        if size == 0:
+            return next(iter(candidates))
+
+        partial = self._hasher.partial(file.path, size, file.mtime)
+        self._hash_partial(list(candidates))
+        matches = [candidate for candidate in candidates
+                   if self._partial[candidate] == partial]
+        if not matches or partial_is_full(size):
+            return matches[0] if matches else ''
+
+        # Digests are compared if both are known, otherwise content is,
+        # which stops at the first difference instead of reading it all
+        full = self._hasher.known_full(file.path, size, file.mtime)
+        for candidate in matches:
+            if full and candidate in self._full:
+                if self._full[candidate] == full:
+                    return candidate
+            elif self._hasher.compare(
+                    file.path, self._origins.get(candidate, candidate), size):
+                return candidate
+        return ''
+
+    def find_similar(self, file, threshold):
+        """
+        Returns paths of non-empty destination files whose content is
+        at least <threshold> similar to <file>, with their similarity,
+        the most similar first. Signatures of the whole destination
+        are computed on the first call, or taken from the catalog.
+        """
+        if self._similar is None:
+            self._similar = LSHIndex()
+            self._unindexed = dict.fromkeys(self._files)
+        if self._unindexed:
+            paths = [path for path in self._unindexed
+                     if self._files[path].size]
+            self._fingerprint(paths)
+            for path in paths:
+                self._similar.add(path, self._fingerprints[path])
+            self._unindexed.clear()
+        return self._similar.find(
+            self._hasher.fingerprint(file.path, file.size, file.mtime),
+            threshold)
+
+    def has_size(self, size):
+        """
+        Returns True if any indexed file has <size> bytes
+        """
+        return size in self._by_size
+
+    def find_name(self, name):
+        """
+        Returns path of the destination file named <name>
+        or empty string if there is none.
+        """
+        same_name = self._names.get(name)
+        return next(iter(same_name)) if same_name else ''
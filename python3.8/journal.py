@@ -0,0 +1,110 @@
+import os
+import json
+
+from plan import Operation
+
+SYNC_INTERVAL = 64
+
+
+class Journal:
+    """
+    Write-ahead journal of operations applied to the destination folder.
+    Operations are written and synced before any of them is applied,
+    completions are synced in batches. Each line is a JSON record:
+        {"seq": 3, "op": {"kind": "copy", ...}}  - operation to apply
+        {"seq": 3}                               - completed operation
+    Journal is kept if the run was interrupted, so it can be resumed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._seq = 0
+        self._pending = set()
+        self._unsynced = 0
+
+    def load(self):
+        """
+        Reads journal of an interrupted run and returns its completed
+        and pending operations in order
+        """
+        planned = {}
+        completed = set()
+        try:
+            with open(self.path) as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Last line was torn by the interruption
+                        break
+                    if 'op' in record:
+                        planned[record['seq']] = \
+                            Operation.from_json(record['op'])
+                    else:
+                        completed.add(record['seq'])
+        except FileNotFoundError:
+            pass
+        return ([operation for seq, operation in planned.items()
+                 if seq in completed],
+                [operation for seq, operation in planned.items()
+                 if seq not in completed])
+
+    def open(self, completed=()):
+        """
+        Starts a new journal keeping <completed> operations of resumed run
+        """
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as file:
+            for seq, operation in enumerate(completed):
+                file.write(json.dumps({'seq': seq, 'op': operation.to_json()})
+                           + '\n' + json.dumps({'seq': seq}) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.path)
+        self._seq = len(completed)
+        self._file = open(self.path, 'a')
+
+    def plan(self, operations):
+        """
+        Records operations about to be applied and returns their numbers
+        """
+        numbers = range(self._seq, self._seq + len(operations))
+        self._seq = numbers.stop
+        if self._file is None:
+            return numbers
+        for seq, operation in zip(numbers, operations):
+            self._file.write(json.dumps({'seq': seq,
+                                         'op': operation.to_json()}) + '\n')
+        self._pending.update(numbers)
+        self._sync()
+        return numbers
+
+    def complete(self, seq):
+        """
+        Records that operation number <seq> was applied
+        """
+        if self._file is None:
+            return
+        self._pending.discard(seq)
+        self._file.write(json.dumps({'seq': seq}) + '\n')
+        self._unsynced += 1
+        if self._unsynced >= SYNC_INTERVAL:
+            self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self, finished):
+        """
+        Syncs the journal, removes it if the run <finished>
+        and all operations were applied
+        """
+        if self._file is None:
+            return
+        self._sync()
+        self._file.close()
+        self._file = None
+        if finished and not self._pending:
+            os.remove(self.path)
@@ -1,9 +1,13 @@
 import sys
 import os
+import signal
 import argparse
 
+from archive import is_archive
 from config import Config
-from file_manager import FileManager
+from copier import COPY_MODES, DEDUPE_MODES
+from file_manager import FileManager, ShardedFileManager
+from metrics import PROFILES, metrics, profiling
 
 
 def check_path(path):
@@ -32,19 +36,114 @@ def get_arguments():
     parser.add_argument('-b',
                         '--batchmode',
                         action='store_true')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=1)
+    parser.add_argument('--hash-jobs',
+                        type=int,
+                        default=1)
+    parser.add_argument('--scan-jobs',
+                        type=int,
+                        default=1)
+    parser.add_argument('--shards',
+                        type=int,
+                        default=1)
+    parser.add_argument('--copy-mode',
+                        choices=COPY_MODES,
+                        default='auto')
+    parser.add_argument('--dedupe',
+                        choices=DEDUPE_MODES,
+                        default='')
+    parser.add_argument('-c',
+                        '--checksum',
+                        action='store_true')
+    parser.add_argument('--near-duplicates',
+                        type=float,
+                        default=0)
+    parser.add_argument('-n',
+                        '--dry-run',
+                        action='store_true')
+    parser.add_argument('--plan',
+                        default='')
+    parser.add_argument('--execute',
+                        default='')
+    parser.add_argument('--decisions',
+                        default='')
+    parser.add_argument('--resume',
+                        action='store_true')
+    parser.add_argument('--watch',
+                        action='store_true')
+    parser.add_argument('--stats',
+                        default='')
+    parser.add_argument('--stats-interval',
+                        type=float,
+                        default=0)
+    parser.add_argument('--profile',
+                        choices=PROFILES)
 
     args = parser.parse_args()
 
-    destination_dir = check_path(args.destination)
-    source_dirs = [check_path(path=path) for path in args.source]
+    args.destination = check_path(args.destination)
+    args.source = [check_path(path=path) for path in args.source]
+    for path in args.source:
+        if not os.path.isdir(path) and not is_archive(path):
+            print(f"==| Source {path} is not a directory or an archive. |==")
+            sys.exit(-1)
+    if args.decisions:
+        args.decisions = check_path(args.decisions)
+    if args.execute:
+        args.execute = check_path(args.execute)
+        if args.dry_run or args.resume:
+            print("==| Saved plan can't be executed with --dry-run"
+                  " or --resume. |==")
+            sys.exit(-1)
+    if args.jobs < 1 or args.hash_jobs < 1 or args.scan_jobs < 1 \
+            or args.shards < 1:
+        print("==| Number of jobs must be positive. |==")
+        sys.exit(-1)
+    if args.shards > 1 and (not args.batchmode or args.resume or args.watch
+                            or args.dedupe or args.plan
+                            or args.execute):
+        print("==| Shards run in batch mode only, without --resume,"
+              " --watch, --dedupe, --plan and --execute. |==")
+        sys.exit(-1)
+    if not 0 <= args.near_duplicates <= 1:
+        print("==| Similarity threshold must be between 0 and 1. |==")
+        sys.exit(-1)
 
-    return destination_dir, source_dirs, args.batchmode
+    return args
 
 
 if __name__ == "__main__":
-    destination, source, batchmode = get_arguments()
-    config = Config(destination, source, batchmode)
-    file_manager = FileManager(destination=destination,
-                               source=source,
-                               config=config)
-    file_manager.start()
+    args = get_arguments()
+    try:
+        config = Config(args.destination, args.source, args.batchmode,
+                        jobs=args.jobs, hash_jobs=args.hash_jobs,
+                        scan_jobs=args.scan_jobs, shards=args.shards,
+                        copy_mode=args.copy_mode, dedupe=args.dedupe,
+                        checksum=args.checksum,
+                        near_duplicates=args.near_duplicates,
+                        dry_run=args.dry_run,
+                        plan_file=args.plan, execute_file=args.execute,
+                        decisions_file=args.decisions,
+                        resume=args.resume, watch=args.watch)
+    except ValueError as error:
+        print(f"==| Invalid config: {error} |==")
+        sys.exit(-1)
+    manager = ShardedFileManager if args.shards > 1 else FileManager
+    file_manager = manager(destination=args.destination,
+                           source=args.source,
+                           config=config)
+    # Let planned operations be applied and journaled on termination,
+    # FileManager cancels its run on the event loop instead
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(-1))
+    if args.stats_interval > 0:
+        metrics.start_reporting(args.stats, args.stats_interval)
+    try:
+        with profiling(args.profile):
+            file_manager.start()
+    finally:
+        metrics.stop_reporting()
+        if args.stats or args.stats_interval > 0:
+            metrics.write(args.stats)
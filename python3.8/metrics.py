@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import math
+import time
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+
+PROFILES = ('cpu', 'memory')
+PROFILE_TOP = 25
+
+
+def syscall_counts():
+    """
+    Returns numbers of read and write syscalls of this process so far
+    """
+    try:
+        with open('/proc/self/io') as file:
+            counters = dict(line.split(': ') for line in file)
+    except OSError:
+        return None
+    return {'read': int(counters['syscr']), 'write': int(counters['syscw'])}
+
+
+class Histogram:
+    """
+    Distribution of observed values in power of two buckets
+    """
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.buckets = {}
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        exponent = math.ceil(math.log2(value)) if value > 0 else -math.inf
+        self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+
+    def to_json(self):
+        return {'count': self.count, 'total': self.total,
+                'min': self.min, 'max': self.max,
+                'mean': self.total / self.count,
+                'buckets': {f"<={2.0 ** exponent:g}": count
+                            for exponent, count
+                            in sorted(self.buckets.items())}}
+
+
+class Metrics:
+    """
+    Counters and histograms of the run, safe to update from threads.
+    Time is measured in seconds and sizes in bytes.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._start = time.perf_counter()
+        self._syscalls = syscall_counts()
+        self._reporter = None
+        self._stop = threading.Event()
+
+    def reset(self):
+        """
+        Drops all values, e.g. inherited by a forked worker process
+        """
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+        self._start = time.perf_counter()
+        self._syscalls = syscall_counts()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """
+        Observes time spent in the with block
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        """
+        Returns current values of all metrics
+        """
+        with self._lock:
+            snapshot = {
+                'seconds': time.perf_counter() - self._start,
+                'counters': dict(self._counters),
+                'histograms': {name: histogram.to_json() for name, histogram
+                               in sorted(self._histograms.items())},
+            }
+        syscalls = syscall_counts()
+        if syscalls and self._syscalls:
+            snapshot['syscalls'] = {name: syscalls[name] - self._syscalls[name]
+                                    for name in syscalls}
+            files = snapshot['counters'].get('files_checked')
+            if files:
+                snapshot['syscalls']['per_file'] = \
+                    sum(snapshot['syscalls'].values()) / files
+        return snapshot
+
+    def write(self, filename=''):
+        """
+        Writes metrics as JSON to <filename>, to stderr if not given
+        """
+        data = json.dumps(self.snapshot(), indent=2)
+        if not filename:
+            print(data, file=sys.stderr)
+            return
+        temporary = filename + '.tmp'
+        with open(temporary, 'w') as file:
+            file.write(data + '\n')
+        os.replace(temporary, filename)
+
+    def start_reporting(self, filename, interval):
+        """
+        Writes metrics every <interval> seconds in background
+        """
+        def report():
+            while not self._stop.wait(interval):
+                self.write(filename)
+
+        self._reporter = threading.Thread(target=report, daemon=True)
+        self._reporter.start()
+
+    def stop_reporting(self):
+        if self._reporter is not None:
+            self._stop.set()
+            self._reporter.join()
+
+
+metrics = Metrics()
+
+
+@contextlib.contextmanager
+def profiling(kind):
+    """
+    Profiles the with block with cProfile (cpu) or tracemalloc (memory)
+    and writes results to file_manager-<kind>.prof
+    """
+    filename = f"file_manager-{kind}.prof"
+    if kind == 'cpu':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(filename)
+            print(f"==| CPU profile written to {filename} |==")
+    elif kind == 'memory':
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            with open(filename, 'w') as file:
+                file.write(f"Peak traced memory: {peak} bytes\n")
+                for statistic in \
+                        snapshot.statistics('lineno')[:PROFILE_TOP]:
+                    file.write(f"{statistic}\n")
+            print(f"==| Memory profile written to {filename} |==")
+    else:
+        yield
@@ -0,0 +1,66 @@
+import re
+import fnmatch
+
+POLICY_ACTIONS = ('always', 'never', 'default', 'ask')
+RULE_FIELDS = {'action': str, 'glob': str, 'min_size': int, 'max_size': int}
+
+
+class Rule:
+    """
+    Policy action for files matching optional glob and size range
+    """
+    __slots__ = ('action', 'pattern', 'min_size', 'max_size')
+
+    def __init__(self, action, glob='',
+                 min_size=0, max_size=-1):
+        if action not in POLICY_ACTIONS:
+            raise ValueError(
+                f"{action} is not one of {', '.join(POLICY_ACTIONS)}.")
+        self.action = action
+        self.pattern = re.compile(fnmatch.translate(glob)) if glob else None
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def matches(self, file):
+        return file.size >= self.min_size \
+            and (self.max_size < 0 or file.size <= self.max_size) \
+            and (self.pattern is None
+                 or self.pattern.match(file.path) is not None)
+
+
+class Policy:
+    """
+    Decides what to do with a file that didn't pass a check.
+    In config a policy is an action or a list of rules, first matching
+    rule wins and files matching no rule are asked about:
+        [{"action": "never", "glob": "*.tmp", "max_size": 1024}, "ask"]
+    Actions:
+        always  - copy the file anyway
+        never   - don't copy the file
+        default - apply default action of the check
+        ask     - leave the decision to the user, deferred until
+                  all other files are planned
+    """
+    def __init__(self, rules):
+        if isinstance(rules, (str, dict)):
+            rules = [rules]
+        self._rules = tuple(self._compile(rule) for rule in rules)
+
+    @staticmethod
+    def _compile(rule):
+        if isinstance(rule, str):
+            rule = {'action': rule}
+        if not isinstance(rule, dict) or 'action' not in rule \
+                or any(not isinstance(rule[field], RULE_FIELDS.get(field, ()))
+                       for field in rule):
+            raise ValueError(f"{rule} is not a valid policy rule.")
+        return Rule(**rule)
+
+    def decide(self, file):
+        """
+        Returns action of the first rule matching <file>
+        """
+        for rule in self._rules:
+            if rule.matches(file):
+                return rule.action
+        return 'ask'
@@ -0,0 +1,140 @@
+import os
+import stat
+from collections import deque
+
+from archive import is_archive, read_members
+from file_info import FileInfo
+
+ORDERS = ('bfs', 'dfs')
+SYMLINK_POLICIES = ('skip', 'files', 'follow')
+SPECIAL_FILE_POLICIES = ('skip', 'warn')
+
+SKIP, FILE, DIRECTORY = range(3)
+
+
+class Walker:
+    """
+    Lazily iterates through files of the folder structure
+    using an explicit stack (dfs) or queue (bfs) of directories.
+
+    Symlink policies:
+        skip   - ignore symlinks
+        files  - treat links to regular files as files, don't enter
+                 linked directories
+        follow - also enter linked directories (each directory once)
+    Special file (fifo, socket, device) policies:
+        skip   - ignore silently
+        warn   - ignore and print a warning
+    Directories in <exclude> aren't entered.
+    Archives given as roots are walked like directories of their members,
+    in a single read. Content of every member can be read only while
+    it's streamed, so it's passed to <read> then, e.g. to be hashed.
+    """
+    def __init__(self,
+                 order='dfs',
+                 symlinks='files',
+                 special_files='warn',
+                 exclude=frozenset(),
+                 read=None):
+        for value, allowed in ((order, ORDERS),
+                               (symlinks, SYMLINK_POLICIES),
+                               (special_files, SPECIAL_FILE_POLICIES)):
+            if value not in allowed:
+                raise ValueError(
+                    f"{value} is not one of {', '.join(allowed)}.")
+        self._order = order
+        self._symlinks = symlinks
+        self._special_files = special_files
+        self._exclude = exclude
+        self._read = read
+
+    def walk(self, root):
+        """
+        Yields FileInfo of every file under <root>
+        """
+        if is_archive(root):
+            return self._walk_archive(root)
+        visited = set()
+        if self._symlinks == 'follow':
+            st = os.stat(root)
+            visited.add((st.st_dev, st.st_ino))
+        if self._order == 'bfs':
+            return self._walk_bfs(root, visited)
+        return self._walk_dfs(root, visited)
+
+    def _walk_bfs(self, root,
+                  visited):
+        queue = deque([root])
+        while queue:
+            with os.scandir(queue.popleft()) as entries:
+                for entry in entries:
+                    kind = self._classify(entry, visited)
+                    if kind == FILE:
+                        yield FileInfo.from_entry(entry)
+                    elif kind == DIRECTORY:
+                        queue.append(entry.path)
+
+    def _walk_dfs(self, root,
+                  visited):
+        # Directories are listed up front so that deep trees
+        # don't keep a file descriptor open per level
+        stack = [self._list(root)]
+        while stack:
+            entry = next(stack[-1], None)
+            if entry is None:
+                stack.pop()
+                continue
+            kind = self._classify(entry, visited)
+            if kind == FILE:
+                yield FileInfo.from_entry(entry)
+            elif kind == DIRECTORY:
+                stack.append(self._list(entry.path))
+
+    def _walk_archive(self, root):
+        for member, content in read_members(root):
+            if content is None:
+                if self._special_files == 'warn':
+                    print(f"==| Skipping special file {member.path} |==")
+                continue
+            if self._read is not None:
+                self._read(member, content)
+            yield member
+
+    def _list(self, path):
+        with os.scandir(path) as entries:
+            return iter(list(entries))
+
+    def _classify(self, entry,
+                  visited):
+        """
+        Decides whether entry is a file, a directory to enter or is skipped
+        using only cached DirEntry type (and stat for symlinks)
+        """
+        if entry.path in self._exclude:
+            return SKIP
+        if entry.is_symlink():
+            if self._symlinks == 'skip':
+                return SKIP
+            try:
+                st = entry.stat()
+            except OSError:
+                return SKIP
+            if stat.S_ISDIR(st.st_mode):
+                if self._symlinks != 'follow' or \
+                        (st.st_dev, st.st_ino) in visited:
+                    return SKIP
+                visited.add((st.st_dev, st.st_ino))
+                return DIRECTORY
+            if stat.S_ISREG(st.st_mode):
+                return FILE
+        elif entry.is_dir(follow_symlinks=False):
+            if self._symlinks == 'follow':
+                st = entry.stat(follow_symlinks=False)
+                visited.add((st.st_dev, st.st_ino))
+            return DIRECTORY
+        elif entry.is_file(follow_symlinks=False):
+            return FILE
+
+        if self._special_files == 'warn':
+            print(f"==| Skipping special file {entry.path} |==")
+        return SKIP